@@ -0,0 +1,825 @@
+#!/usr/bin/env python3
+
+"""
+Measure time-to-recovery of the supervisor against local stand-ins.
+
+Runs main.Supervisor in-process with every external party replaced by a
+fake on the loopback interface, so the whole benchmark works offline on
+one Linux box:
+
+  * STUN servers backed by a fake NAT that publishes mappings on 127.0.0.2
+  * an RFC 5780 server on 127.0.0.1 and 127.0.0.3 for the NAT behavior
+    test, which maps and filters like the NAT type given by --nat-behavior
+  * an SSDP/SOAP Internet Gateway Device, and optionally a PCP/NAT-PMP
+    gateway that answers PCP, acts as a NAT-PMP only router or stays
+    silent (--gateway)
+  * the hentaiathome.php settings page, which locks f_port while the
+    client is online
+  * the keep-alive and network probe server
+  * a stub hath-rust binary that reports start and stop to the fake
+    settings page, like the real client does with the RPC server
+
+Each scenario injects a fault, breaks the current mapping and times how
+long the supervisor takes to get back to serving with the new port shown
+on the settings page. With --relay the scenarios run in relay mode, where
+hath-rust stays on a fixed local port. Linux only: the fake NAT relies on
+the whole of 127.0.0.0/8 being routed to the loopback device.
+"""
+
+import os
+import sys
+import time
+import stat
+import shutil
+import random
+import select
+import socket
+import struct
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from main import Supervisor, State
+
+OUTER_IP = "127.0.0.2"
+STUN_MAGIC = 0x2112A442
+
+STUB_HATH_RUST = """#!%(python)s
+import os, sys, signal, socket, threading, urllib.request
+
+port = int(sys.argv[sys.argv.index("--port") + 1])
+rpc = os.environ["HATH_BENCH_RPC"]
+
+
+def notify(act):
+    urllib.request.urlopen("%%s?act=%%s" %% (rpc, act), timeout=5).read()
+
+
+def stop(*_):
+    print("client_stop: shutting down", flush=True)
+    notify("client_stop")
+    os._exit(0)
+
+
+signal.signal(signal.SIGTERM, stop)
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# loopback only, outside traffic has to come through the fake NAT
+server.bind(("127.0.0.1", port))
+server.listen(128)
+notify("client_start")
+print("startup finished", flush=True)
+while True:
+    conn, _ = server.accept()
+    conn.close()
+"""
+
+
+class FakeNat(object):
+    # full-cone NAT: TCP source port P is published as OUTER_IP:Q and
+    # forwarded to 127.0.0.1:P; remap() moves every mapping (or only those
+    # of the given source ports) to a new Q
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mappings = {}  # source port => (outer port, listener)
+        self.keepalive = None
+
+    def outer_port(self, source_port):
+        with self.lock:
+            entry = self.mappings.get(source_port)
+            if entry:
+                return entry[0]
+            self.mappings[source_port] = self._listen(source_port)
+            return self.mappings[source_port][0]
+
+    def remap(self, source_ports=None):
+        with self.lock:
+            for source_port, (_, listener) in list(self.mappings.items()):
+                if source_ports is not None and source_port not in source_ports:
+                    continue
+                # shutdown() wakes the accept() blocked in the forwarder thread
+                try:
+                    listener.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                listener.close()
+                self.mappings[source_port] = self._listen(source_port)
+        # established connections through the NAT die with the mapping
+        if self.keepalive:
+            self.keepalive.drop_connections(source_ports)
+
+    def _listen(self, source_port):
+        # a real NAT lives on another box: never publish the source port
+        # number itself, the relay and the hairpin check listen on 0.0.0.0
+        # there. Outer ports stay below the ephemeral range for the same reason
+        while True:
+            outer_port = random.randint(20000, 32767)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((OUTER_IP, outer_port))
+                sock.listen(128)
+                break
+            except OSError:
+                sock.close()
+        threading.Thread(
+            target=self._accept, args=(sock, source_port), daemon=True
+        ).start()
+        return outer_port, sock
+
+    def _accept(self, sock, source_port):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._forward, args=(conn, source_port), daemon=True
+            ).start()
+
+    def _forward(self, conn, source_port):
+        try:
+            upstream = socket.create_connection(("127.0.0.1", source_port), timeout=3)
+        except OSError:
+            conn.close()
+            return
+        socks = [conn, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(socks, [], [], 30)
+                if not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    (upstream if sock is conn else conn).sendall(data)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            upstream.close()
+
+
+def stun_response(request, attrs):
+    body = b"".join(
+        struct.pack("!HH", attr_type, len(value)) + value for attr_type, value in attrs
+    )
+    return struct.pack("!HHL", 0x0101, len(body), STUN_MAGIC) + request[8:20] + body
+
+
+def xor_addr(ip, port):
+    ip = struct.unpack("!L", socket.inet_aton(ip))[0]
+    return struct.pack("!BBHL", 0, 1, port ^ 0x2112, ip ^ STUN_MAGIC)
+
+
+class FakeStunServer(object):
+    def __init__(self, nat):
+        self.nat = nat
+        # "ok", or "dead" to accept and never answer like a black-holed server
+        self.mode = "ok"
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(("127.0.0.1", 0))
+        self.tcp.listen(128)
+        self.port = self.tcp.getsockname()[1]
+        self._held = []
+        threading.Thread(target=self._serve_tcp, daemon=True).start()
+
+    def _serve_tcp(self):
+        while True:
+            conn, addr = self.tcp.accept()
+            if self.mode == "dead":
+                self._held.append(conn)
+                continue
+            threading.Thread(
+                target=self._handle_tcp, args=(conn, addr), daemon=True
+            ).start()
+
+    def _handle_tcp(self, conn, addr):
+        with conn:
+            try:
+                request = conn.recv(1500)
+                if len(request) < 20:
+                    return
+                outer_port = self.nat.outer_port(addr[1])
+                conn.sendall(
+                    stun_response(request, [(0x0020, xor_addr(OUTER_IP, outer_port))])
+                )
+            except OSError:
+                pass
+
+    def release(self):
+        for conn in self._held:
+            conn.close()
+        self._held = []
+
+
+class FakeNatTestServer(object):
+    """RFC 5780 server on two addresses and two ports, behind a simulated NAT"""
+
+    ALT_IP = "127.0.0.3"
+    # (mapping, filtering), each "ei", "ad" or "apd"
+    BEHAVIORS = {
+        "full-cone": ("ei", "ei"),
+        "restricted": ("ei", "ad"),
+        "port-restricted": ("ei", "apd"),
+        "symmetric": ("apd", "apd"),
+    }
+
+    def __init__(self, behavior):
+        self.mapping, self.filtering = self.BEHAVIORS[behavior]
+        self._lock = threading.Lock()
+        self._sent = {}  # client port => {(ip, port) it has sent to}
+        self._ports = {}  # NAT binding => outer port
+        # the other three sockets sit on the port after a random one, which
+        # may be taken
+        while True:
+            self.socks = {}
+            try:
+                sock = self._bind("127.0.0.1", 0)
+                self.port = sock.getsockname()[1]
+                self.socks = {("127.0.0.1", self.port): sock}
+                self._bind("127.0.0.1", self.port + 1)
+                self._bind(self.ALT_IP, self.port)
+                self._bind(self.ALT_IP, self.port + 1)
+                break
+            except OSError:
+                for sock in self.socks.values():
+                    sock.close()
+        for addr, sock in self.socks.items():
+            threading.Thread(target=self._serve, args=(addr, sock), daemon=True).start()
+
+    def _bind(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socks[(ip, port)] = sock
+        sock.bind((ip, port))
+        return sock
+
+    def _outer_port(self, client_port, dest):
+        if self.mapping == "ei":
+            return client_port
+        key = (client_port, dest[0]) if self.mapping == "ad" else (client_port, dest)
+        with self._lock:
+            return self._ports.setdefault(key, 20000 + len(self._ports))
+
+    def _passes(self, client_port, source):
+        if self.filtering == "ei":
+            return True
+        with self._lock:
+            sent = self._sent.get(client_port, set())
+        if self.filtering == "ad":
+            return any(ip == source[0] for ip, _ in sent)
+        return source in sent
+
+    def _serve(self, local, sock):
+        while True:
+            request, addr = sock.recvfrom(1500)
+            if len(request) < 20:
+                continue
+            with self._lock:
+                self._sent.setdefault(addr[1], set()).add(local)
+            flags = 0
+            if request[20:24] == struct.pack("!HH", 0x0003, 4):
+                flags = struct.unpack("!L", request[24:28])[0]
+            ip, port = local
+            if flags & 4:
+                ip = self.ALT_IP if ip == "127.0.0.1" else "127.0.0.1"
+            if flags & 2:
+                port = self.port + 1 if port == self.port else self.port
+            if not self._passes(addr[1], (ip, port)):
+                continue
+            other_ip = self.ALT_IP if local[0] == "127.0.0.1" else "127.0.0.1"
+            other_port = self.port + 1 if local[1] == self.port else self.port
+            other = struct.pack(
+                "!BBHL",
+                0,
+                1,
+                other_port,
+                struct.unpack("!L", socket.inet_aton(other_ip))[0],
+            )
+            outer_port = self._outer_port(addr[1], local)
+            self.socks[(ip, port)].sendto(
+                stun_response(
+                    request,
+                    [(0x0020, xor_addr(OUTER_IP, outer_port)), (0x802C, other)],
+                ),
+                addr,
+            )
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b"", content_type="text/html"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+def start_http(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeKeepAlive(object):
+    # keep-alive target and network probe; remembers its connections so the
+    # fake NAT can cut them
+    def __init__(self):
+        self.conns = set()
+        owner = self
+
+        class Handler(_QuietHandler):
+            def setup(self):
+                super().setup()
+                owner.conns.add(self.connection)
+
+            def finish(self):
+                owner.conns.discard(self.connection)
+                super().finish()
+
+            def do_HEAD(self):
+                self.reply(200)
+
+        self.server = start_http(Handler)
+        self.port = self.server.server_address[1]
+
+    def drop_connections(self, source_ports=None):
+        for conn in list(self.conns):
+            try:
+                if source_ports is not None:
+                    if conn.getpeername()[1] not in source_ports:
+                        continue
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class FakeIgd(object):
+    SERVICE = "urn:schemas-upnp-org:service:WANIPConnection:1"
+
+    def __init__(self):
+        self.delay = 0
+        self.mappings = {}
+        owner = self
+
+        class Handler(_QuietHandler):
+            def do_GET(self):
+                body = (
+                    '<?xml version="1.0"?><root xmlns="urn:schemas-upnp-org:device-1-0">'
+                    "<device><deviceType>urn:schemas-upnp-org:device:"
+                    "InternetGatewayDevice:1</deviceType><serviceList><service>"
+                    "<serviceType>%s</serviceType>"
+                    "<serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>"
+                    "<controlURL>/ctl</controlURL><eventSubURL>/evt</eventSubURL>"
+                    "<SCPDURL>/scpd.xml</SCPDURL></service></serviceList></device></root>"
+                    % owner.SERVICE
+                ).encode()
+                self.reply(200, body, "text/xml")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                action = self.headers["SOAPAction"].strip('"').rsplit("#", 1)[-1]
+                time.sleep(owner.delay)
+                status, result = owner.call(action, body)
+                self.reply(status, result.encode(), "text/xml")
+
+        self.http = start_http(Handler)
+        self.ssdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ssdp.bind(("127.0.0.1", 0))
+        self.ssdp_port = self.ssdp.getsockname()[1]
+        threading.Thread(target=self._serve_ssdp, daemon=True).start()
+
+    def _serve_ssdp(self):
+        location = "http://127.0.0.1:%d/desc.xml" % self.http.server_address[1]
+        while True:
+            request, addr = self.ssdp.recvfrom(4096)
+            if not request.startswith(b"M-SEARCH"):
+                continue
+            time.sleep(self.delay)
+            self.ssdp.sendto(
+                (
+                    "HTTP/1.1 200 OK\r\nCACHE-CONTROL: max-age=120\r\n"
+                    "ST: %s\r\nLOCATION: %s\r\n\r\n" % (self.SERVICE, location)
+                ).encode(),
+                addr,
+            )
+
+    def call(self, action, body):
+        def arg(name):
+            start = body.find("<%s>" % name)
+            if start < 0:
+                return ""
+            start += len(name) + 2
+            return body[start : body.find("</%s>" % name, start)]
+
+        envelope = (
+            '<?xml version="1.0"?><s:Envelope '
+            'xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>%s'
+            "</s:Body></s:Envelope>"
+        )
+        port = arg("NewExternalPort")
+        if action == "AddPortMapping":
+            self.mappings[port] = (
+                arg("NewInternalClient"),
+                arg("NewInternalPort"),
+                arg("NewLeaseDuration"),
+            )
+            out = ""
+        elif action == "GetSpecificPortMappingEntry" and port in self.mappings:
+            client, internal, lease = self.mappings[port]
+            out = (
+                "<NewInternalPort>%s</NewInternalPort>"
+                "<NewInternalClient>%s</NewInternalClient>"
+                "<NewLeaseDuration>%s</NewLeaseDuration>" % (internal, client, lease)
+            )
+        elif action == "DeletePortMapping" and port in self.mappings:
+            del self.mappings[port]
+            out = ""
+        elif action == "GetExternalIPAddress":
+            out = "<NewExternalIPAddress>%s</NewExternalIPAddress>" % OUTER_IP
+        else:
+            return 500, envelope % (
+                "<s:Fault><faultcode>s:Client</faultcode><faultstring>UPnPError"
+                '</faultstring><detail><UPnPError xmlns="urn:schemas-upnp-org:'
+                'control-1-0"><errorCode>714</errorCode><errorDescription>'
+                "NoSuchEntryInArray</errorDescription></UPnPError></detail></s:Fault>"
+            )
+        return 200, envelope % (
+            '<u:%sResponse xmlns:u="%s">%s</u:%sResponse>'
+            % (action, self.SERVICE, out, action)
+        )
+
+
+class FakePcpGateway(object):
+    # UDP gateway: "pcp" answers PCP MAP, "pcp-busy" hands out another
+    # external port than the one asked for, "natpmp" answers PCP requests
+    # with UNSUPP_VERSION like a NAT-PMP only router, "silent" never answers
+    def __init__(self, mode):
+        self.mode = mode
+        self.mappings = {}  # internal port => external port
+        self.deleted = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.epoch = int(time.monotonic())
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            request, addr = self.sock.recvfrom(1100)
+            if self.mode == "silent" or len(request) < 2:
+                continue
+            if request[0] == 2:
+                response = self._pcp(request)
+            else:
+                response = self._natpmp(request)
+            if response:
+                self.sock.sendto(response, addr)
+
+    def _epoch(self):
+        return int(time.monotonic()) - self.epoch
+
+    def _update(self, internal, external, lifetime):
+        if lifetime:
+            if self.mode == "pcp-busy":
+                external = external % 40000 + 20000
+            self.mappings[internal] = external
+        elif self.mappings.pop(internal, None) is not None:
+            self.deleted += 1
+        return external
+
+    def _pcp(self, request):
+        if self.mode == "natpmp":
+            # RFC 6887 section 9: version 0, result 1 (UNSUPP_VERSION)
+            return struct.pack("!BBHL", 0, 128 + request[1], 1, self._epoch())
+        if len(request) < 60 or request[1] != 1:
+            return None
+        lifetime = struct.unpack("!L", request[4:8])[0]
+        internal, external = struct.unpack("!HH", request[40:44])
+        external = self._update(internal, external, lifetime)
+        return (
+            struct.pack("!BBBBLL", 2, 0x81, 0, 0, lifetime, self._epoch())
+            + b"\0" * 12
+            + request[24:42]
+            + struct.pack("!H", external)
+            + b"\0" * 10
+            + b"\xff\xff"
+            + socket.inet_aton(OUTER_IP)
+        )
+
+    def _natpmp(self, request):
+        if request[1] == 0:
+            ip = struct.unpack("!L", socket.inet_aton(OUTER_IP))[0]
+            return struct.pack("!BBHLL", 0, 128, 0, self._epoch(), ip)
+        if request[1] != 2 or len(request) < 12:
+            return None
+        _, _, _, internal, external, lifetime = struct.unpack("!BBHHHL", request[:12])
+        self._update(internal, external, lifetime)
+        return struct.pack(
+            "!BBHLHHL", 0, 130, 0, self._epoch(), internal, external, lifetime
+        )
+
+
+class FakeSettingsPage(object):
+    # hentaiathome.php?act=settings; f_port is locked while the client is online
+    def __init__(self):
+        self.online = False
+        self.port = "0"
+        self.outage_until = 0
+        owner = self
+
+        class Handler(_QuietHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                if url.path == "/rpc":
+                    owner.online = query["act"][0] == "client_start"
+                    self.reply(200, b"OK")
+                    return
+                if time.monotonic() < owner.outage_until:
+                    self.reply(502, b"Bad Gateway")
+                    return
+                self.reply(200, owner.page())
+
+            def do_POST(self):
+                data = parse_qs(
+                    self.rfile.read(int(self.headers["Content-Length"])).decode()
+                )
+                if time.monotonic() < owner.outage_until:
+                    self.reply(502, b"Bad Gateway")
+                    return
+                if not owner.online:
+                    owner.port = data["f_port"][0]
+                self.reply(200, owner.page())
+
+        self.server = start_http(Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def page(self):
+        disabled = ' disabled="disabled"' if self.online else ""
+        return (
+            '<form method="post"><input type="text" name="f_name" value="bench" />'
+            '<input type="text" name="f_port" value="%s" size="5"%s />'
+            '<input type="checkbox" name="f_disable_ssl" checked="checked" />'
+            "</form>" % (self.port, disabled)
+        ).encode()
+
+
+class BenchSupervisor(Supervisor):
+    # the benchmark runs a single client and waits for it to reach SERVING
+    def __init__(self, config, path):
+        super().__init__(config, path)
+        self.serving = None
+        self.client = self.clients[0]
+        set_state = self.client._set_state
+
+        def _set_state(state):
+            set_state(state)
+            if state == State.SERVING and self.serving:
+                self.serving.set()
+
+        self.client._set_state = _set_state
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def bench(args):
+    nat = FakeNat()
+    stun_servers = [FakeStunServer(nat) for _ in range(args.stun_servers)]
+    nat_test = FakeNatTestServer(args.nat_behavior)
+    keepalive = FakeKeepAlive()
+    nat.keepalive = keepalive
+    igd = FakeIgd()
+    gateway = FakePcpGateway(args.gateway) if args.gateway != "upnp" else None
+    settings = FakeSettingsPage()
+
+    workdir = tempfile.mkdtemp(prefix="hath-bench-")
+    stub = os.path.join(workdir, "hath-rust")
+    with open(stub, "w") as fo:
+        fo.write(STUB_HATH_RUST % {"python": sys.executable})
+    os.chmod(stub, os.stat(stub).st_mode | stat.S_IEXEC)
+    os.environ["HATH_BENCH_RPC"] = settings.url + "/rpc"
+
+    config = {
+        "access_info": {
+            "ipb_member_id": "1",
+            "ipb_pass_hash": "bench",
+            "client_id": "1",
+            "client_key": "bench",
+        },
+        "proxy": {"enable": False, "cache_download": False, "url": ""},
+        "hath-rust": {
+            "force_background_scan": False,
+            "log_level": 4,
+            "rpc_server_ip": "",
+            "stop_timeout": 5,
+            "ready_timeout": 10,
+        },
+        "standby": {"enable": not args.no_standby},
+        "relay": {"enable": args.relay, "port": free_port()},
+        "network": {
+            "stun_servers": ["127.0.0.1:%d" % s.port for s in stun_servers],
+            "nat_test_servers": ["127.0.0.1:%d" % nat_test.port],
+            "keepalive_server": "127.0.0.1:%d" % keepalive.port,
+            "probe_server": "127.0.0.1:%d" % keepalive.port,
+            "ssdp_addr": "127.0.0.1:%d" % igd.ssdp_port,
+            # without a gateway nothing listens there, so PCP/NAT-PMP fails fast
+            "natpmp_gateway": "127.0.0.1:%d" % (gateway.port if gateway else 5351),
+            "settings_url": settings.url,
+        },
+    }
+    supervisor = BenchSupervisor(config, workdir)
+    supervisor.serving = asyncio.Event()
+
+    def set_dead_stun(dead):
+        for server in stun_servers[:dead]:
+            server.mode = "dead" if dead else "ok"
+        for server in stun_servers[dead:]:
+            server.mode = "ok"
+            server.release()
+
+    def crash():
+        supervisor.client.hathrustclient.process.kill()
+        # no client_stop is sent, the server notices the dead client later
+        threading.Timer(
+            args.offline_delay, lambda: setattr(settings, "online", False)
+        ).start()
+
+    def lose_mapping():
+        # only the serving mapping dies, the spare one survives
+        nat.remap({supervisor.client.mapping.inner_port})
+
+    scenarios = {
+        "port_change": (None, nat.remap, None),
+        "mapping_loss": (None, lose_mapping, None),
+        "dead_stun": (
+            lambda: set_dead_stun(len(stun_servers) - 2),
+            nat.remap,
+            lambda: set_dead_stun(0),
+        ),
+        "proxy_outage": (
+            lambda: setattr(settings, "outage_until", time.monotonic() + args.outage),
+            nat.remap,
+            None,
+        ),
+        "slow_router": (
+            lambda: setattr(igd, "delay", args.router_delay),
+            nat.remap,
+            lambda: setattr(igd, "delay", 0),
+        ),
+        "hath_crash": (None, crash, None),
+    }
+    selected = args.scenario or list(scenarios)
+
+    async def recovered():
+        # in relay mode SERVING comes before the background port update
+        await supervisor.serving.wait()
+        while settings.port != str(supervisor.client.mapping.outer_port):
+            await asyncio.sleep(0.05)
+
+    run = asyncio.create_task(supervisor.run())
+    results = {}
+    start = time.monotonic()
+    await asyncio.wait_for(recovered(), args.timeout)
+    results["cold_start"] = [time.monotonic() - start]
+
+    for name in selected:
+        inject, trigger, revert = scenarios[name]
+        samples = results.setdefault(name, [])
+        for i in range(args.rounds):
+            await asyncio.sleep(args.settle)
+            if inject:
+                inject()
+            supervisor.serving.clear()
+            start = time.monotonic()
+            trigger()
+            try:
+                await asyncio.wait_for(recovered(), args.timeout)
+                samples.append(time.monotonic() - start)
+            except asyncio.TimeoutError:
+                logging.error(
+                    "%s round %d did not recover in %ds", name, i, args.timeout
+                )
+            if revert:
+                revert()
+            print(
+                "%s round %d: %s" % (name, i, samples[-1:] or "timeout"),
+                file=sys.stderr,
+            )
+
+    supervisor._stop_event.set()
+    await run
+    shutil.rmtree(workdir, ignore_errors=True)
+    if gateway:
+        print(
+            "%s gateway: %d mappings deleted, %d left"
+            % (args.gateway, gateway.deleted, len(gateway.mappings)),
+            file=sys.stderr,
+        )
+
+    print(
+        "%-14s %6s %9s %9s %9s %9s"
+        % ("scenario", "runs", "p50 s", "p90 s", "p99 s", "max s")
+    )
+    for name, samples in results.items():
+        if not samples:
+            print("%-14s %6d %9s %9s %9s %9s" % (name, 0, "-", "-", "-", "-"))
+            continue
+        print(
+            "%-14s %6d %9.2f %9.2f %9.2f %9.2f"
+            % (
+                name,
+                len(samples),
+                percentile(samples, 50),
+                percentile(samples, 90),
+                percentile(samples, 99),
+                max(samples),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=[
+            "port_change",
+            "mapping_loss",
+            "dead_stun",
+            "proxy_outage",
+            "slow_router",
+            "hath_crash",
+        ],
+    )
+    parser.add_argument("--stun-servers", type=int, default=5)
+    parser.add_argument(
+        "--no-standby", action="store_true", help="run without a spare mapping"
+    )
+    parser.add_argument(
+        "--gateway",
+        choices=["upnp", "pcp", "pcp-busy", "natpmp", "silent"],
+        default="upnp",
+        help="protocol the router speaks besides UPnP",
+    )
+    parser.add_argument(
+        "--nat-behavior",
+        choices=sorted(FakeNatTestServer.BEHAVIORS),
+        default="full-cone",
+        help="NAT type the NAT behavior test sees",
+    )
+    parser.add_argument(
+        "--relay", action="store_true", help="forward the punched port to hath-rust"
+    )
+    parser.add_argument(
+        "--outage", type=float, default=10, help="proxy outage in seconds"
+    )
+    parser.add_argument(
+        "--router-delay", type=float, default=1, help="IGD response delay in seconds"
+    )
+    parser.add_argument(
+        "--offline-delay",
+        type=float,
+        default=5,
+        help="how long the settings page takes to notice a crashed client",
+    )
+    parser.add_argument("--settle", type=float, default=2, help="pause between rounds")
+    parser.add_argument("--timeout", type=float, default=180)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        # natter configures the root logger on import
+        force=True,
+    )
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Compare ForwardRelay with hath-rust binding the punched port directly.
+
+Reports bulk throughput and per-connection overhead (connect, one small
+request, one small response, close) for a direct connection, the
+zero-copy splice relay and the user-space copy relay.
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from natter import ForwardRelay
+
+
+def start_server(payload_size):
+    # stand-in for hath-rust: "bulk" streams the payload, anything else is echoed
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(512)
+    chunk = b"\0" * 65536
+
+    def handle(conn):
+        with conn:
+            req = conn.recv(64)
+            if req == b"bulk":
+                left = payload_size
+                while left > 0:
+                    n = conn.send(chunk[: min(left, len(chunk))])
+                    left -= n
+            else:
+                conn.sendall(req)
+
+    def loop():
+        while True:
+            conn, _ = sock.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=loop, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_throughput(port, payload_size, rounds):
+    buff = bytearray(1048576)
+    best = 0
+    for _ in range(rounds):
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            start = time.perf_counter()
+            sock.sendall(b"bulk")
+            received = 0
+            while True:
+                n = sock.recv_into(buff)
+                if n == 0:
+                    break
+                received += n
+            elapsed = time.perf_counter() - start
+        best = max(best, received / elapsed)
+    return best
+
+
+def bench_connections(port, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            sock.sendall(b"ping")
+            sock.recv(64)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=256, help="bulk size in MiB")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--connections", type=int, default=2000)
+    args = parser.parse_args()
+
+    server_port = start_server(args.size * 1048576)
+    targets = [("direct", server_port, None)]
+    for name, zero_copy in (("relay-splice", True), ("relay-copy", False)):
+        if zero_copy and not hasattr(os, "splice"):
+            continue
+        relay = ForwardRelay(free_port(), "127.0.0.1", server_port, "127.0.0.1")
+        relay.zero_copy = zero_copy
+        relay.start()
+        targets.append((name, relay.listen_addr[1], relay))
+
+    print("%-14s %12s %14s %14s" % ("path", "MiB/s", "conn p50 ms", "conn p99 ms"))
+    for name, port, relay in targets:
+        throughput = bench_throughput(port, args.size, args.rounds)
+        p50, p99 = bench_connections(port, args.connections)
+        print(
+            "%-14s %12.1f %14.3f %14.3f"
+            % (name, throughput / 1048576, p50 * 1000, p99 * 1000)
+        )
+        if relay:
+            relay.close(drain=False)
+
+
+if __name__ == "__main__":
+    main()
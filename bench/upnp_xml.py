@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Compare the bounded HTTP reader and streaming XML parser with the old UPnP path.
+
+Serves router description files from a local HTTP server with
+Content-Length, chunked and close-delimited framing, then times how long
+UPnPDevice._get_srv_dict takes to fetch and parse them against the
+previous `response += buff` reader with regex extraction. Without --file a
+synthetic description in the shape of a large multi-device IGD (several
+embedded WAN devices and TR-064 style service lists) is generated.
+"""
+
+import os
+import re
+import sys
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from natter import UPnPDevice, XmlFieldParser, split_url, full_url
+
+
+def make_description(devices):
+    services = [
+        "urn:schemas-upnp-org:service:Layer3Forwarding:1",
+        "urn:schemas-upnp-org:service:WANCommonInterfaceConfig:1",
+        "urn:schemas-upnp-org:service:WANDSLLinkConfig:1",
+        "urn:schemas-upnp-org:service:WANIPConnection:1",
+        "urn:schemas-upnp-org:service:WANPPPConnection:1",
+        "urn:dslforum-org:service:DeviceInfo:1",
+        "urn:dslforum-org:service:Hosts:1",
+        "urn:dslforum-org:service:WLANConfiguration:1",
+        "urn:dslforum-org:service:X_AVM-DE_OnTel:1",
+        "urn:dslforum-org:service:X_AVM-DE_Filelinks:1",
+    ]
+    parts = [
+        '<?xml version="1.0"?>\n'
+        '<root xmlns="urn:schemas-upnp-org:device-1-0">\n'
+        "<specVersion><major>1</major><minor>0</minor></specVersion>\n"
+        "<device>\n"
+        "<deviceType>urn:schemas-upnp-org:device:InternetGatewayDevice:1</deviceType>\n"
+        "<friendlyName>Benchmark Router</friendlyName>\n"
+        "<deviceList>\n"
+    ]
+    for d in range(devices):
+        parts.append(
+            "<device>\n"
+            "<deviceType>urn:schemas-upnp-org:device:WANDevice:1</deviceType>\n"
+            "<friendlyName>WAN %d</friendlyName>\n"
+            "<manufacturer>Bench</manufacturer>\n"
+            "<modelDescription>%s</modelDescription>\n"
+            "<UDN>uuid:75802409-bccb-40e7-8e6c-%012d</UDN>\n"
+            "<iconList><icon><mimetype>image/gif</mimetype><width>118</width>"
+            "<height>119</height><depth>8</depth><url>/ligd.gif</url></icon>"
+            "</iconList>\n"
+            "<serviceList>\n" % (d, "x" * 200, d)
+        )
+        for i, srv_type in enumerate(services):
+            name = srv_type.rsplit(":", 2)[-2]
+            parts.append(
+                "<service>\n"
+                "<serviceType>%s</serviceType>\n"
+                "<serviceId>urn:upnp-org:serviceId:%s%d_%d</serviceId>\n"
+                "<controlURL>/upnp/control/%s%d</controlURL>\n"
+                "<eventSubURL>/upnp/control/%s%d</eventSubURL>\n"
+                "<SCPDURL>/%sSCPD.xml</SCPDURL>\n"
+                "</service>\n" % (srv_type, name, d, i, name, d, name, d, name)
+            )
+        parts.append("</serviceList>\n</device>\n")
+    parts.append(
+        "</deviceList>\n"
+        "<presentationURL>http://192.168.178.1</presentationURL>\n"
+        "</device>\n</root>\n"
+    )
+    return "".join(parts).encode()
+
+
+def start_server(documents):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(128)
+
+    def handle(conn):
+        with conn:
+            req = b""
+            while b"\r\n\r\n" not in req:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                req += data
+            mode, name = req.split(b" ", 2)[1].decode().strip("/").split("/", 1)
+            body = documents[name]
+            if mode == "length":
+                conn.sendall(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\n"
+                    b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body)
+                    + body
+                )
+            elif mode == "chunked":
+                conn.sendall(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\n"
+                    b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+                )
+                for i in range(0, len(body), 8192):
+                    chunk = body[i : i + 8192]
+                    conn.sendall(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                conn.sendall(b"0\r\n\r\n")
+            else:
+                conn.sendall(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\n"
+                    b"Connection: close\r\n\r\n" + body
+                )
+
+    def loop():
+        while True:
+            conn, _ = sock.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=loop, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def legacy_get_srv_dict(url):
+    # the reader and parser this benchmark replaces, kept verbatim
+    hostname, port, path = split_url(url)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(3)
+    sock.connect((hostname, port))
+    sock.sendall(
+        (
+            "GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: curl/8.0.0 (Natter)\r\n"
+            "Accept: */*\r\nConnection: close\r\n\r\n" % (path, hostname)
+        ).encode()
+    )
+    response = b""
+    while True:
+        buff = sock.recv(4096)
+        if not buff:
+            break
+        response += buff
+    sock.close()
+    return legacy_parse(response.split(b"\r\n\r\n", 1)[1], url)
+
+
+def legacy_parse(body, url="http://127.0.0.1/"):
+    xmlcontent = body.decode("utf-8", "ignore")
+    services_d = {}
+    for srv_str in re.findall(r"<service\s*>([\s\S]+?)</service\s*>", xmlcontent):
+        srv = {}
+        for tag in ("serviceType", "serviceId", "SCPDURL", "controlURL", "eventSubURL"):
+            m = re.search(r"<%s\s*>([^<]*?)</%s\s*>" % (tag, tag), srv_str)
+            if m:
+                srv[tag] = m.group(1).strip()
+        if "controlURL" in srv:
+            srv["controlURL"] = full_url(srv["controlURL"], url)
+        if srv.get("serviceType") and srv.get("serviceId") and srv.get("controlURL"):
+            services_d[srv["serviceId"]] = srv
+    return services_d
+
+
+def stream_parse(body):
+    xml = XmlFieldParser("service")
+    view = memoryview(body)
+    for i in range(0, len(body), 65536):
+        xml.feed(view[i : i + 65536])
+    return xml.close().records
+
+
+def bench(func, arg, rounds):
+    samples = []
+    count = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        count = len(func(arg))
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return count, samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--file", action="append", default=[], help="router description XML"
+    )
+    parser.add_argument("--devices", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    documents = {}
+    for path in args.file:
+        with open(path, "rb") as fo:
+            documents[os.path.basename(path)] = fo.read()
+    if not documents:
+        documents["synthetic.xml"] = make_description(args.devices)
+
+    port = start_server(documents)
+    device = UPnPDevice("127.0.0.1", [])
+    print(
+        "%-20s %-8s %9s %-7s %9s %12s %12s"
+        % ("document", "framing", "KiB", "parser", "services", "p50 ms", "p99 ms")
+    )
+    for name, body in documents.items():
+        # "parse" leaves out the socket to show the parser cost alone
+        for mode in ("parse", "length", "chunked", "close"):
+            url = "http://127.0.0.1:%d/%s/%s" % (port, mode, name)
+            if mode == "parse":
+                targets = (("legacy", legacy_parse), ("stream", stream_parse))
+                arg = body
+            else:
+                targets = (
+                    ("legacy", legacy_get_srv_dict),
+                    ("stream", device._get_srv_dict),
+                )
+                arg = url
+            for label, func in targets:
+                count, p50, p99 = bench(func, arg, args.rounds)
+                print(
+                    "%-20s %-8s %9.1f %-7s %9d %12.3f %12.3f"
+                    % (
+                        name,
+                        mode,
+                        len(body) / 1024,
+                        label,
+                        count,
+                        p50 * 1000,
+                        p99 * 1000,
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import ctypes
+import select
+import struct
+import threading
+
+# 配置项的类型及是否必填，未列出的项不做检查
+NUMBER = (int, float)
+SCHEMA = {
+    "access_info": {
+        "ipb_member_id": ((int, str), True),
+        "ipb_pass_hash": (str, True),
+        "client_id": ((int, str), False),
+        "client_key": (str, False),
+    },
+    "proxy": {
+        "enable": (bool, True),
+        "cache_download": (bool, True),
+        "url": (str, False),
+    },
+    "hath-rust": {
+        "force_background_scan": (bool, True),
+        "log_level": (int, True),
+        "rpc_server_ip": (str, False),
+        "ready_timeout": (NUMBER, False),
+        "stop_timeout": (NUMBER, False),
+    },
+    "relay": {"enable": (bool, False), "port": (int, False)},
+    "standby": {"enable": (bool, False)},
+    "keepalive": {
+        "calibrate": (bool, False),
+        "interval": (NUMBER, False),
+        "fraction": (NUMBER, False),
+        "max_idle": (NUMBER, False),
+    },
+    "metrics": {"enable": (bool, False), "host": (str, False), "port": (int, False)},
+    "tracing": {"enable": (bool, False), "path": (str, False)},
+    "network": {
+        "stun_servers": (list, False),
+        "nat_test_servers": (list, False),
+        "keepalive_server": (str, False),
+        "probe_server": (str, False),
+        "ssdp_addr": (str, False),
+        "natpmp_gateway": (str, False),
+        "settings_url": (str, False),
+    },
+}
+REQUIRED_SECTIONS = ("access_info", "proxy", "hath-rust")
+CLIENT_SCHEMA = {
+    "client_id": ((int, str), True),
+    "client_key": (str, True),
+    "dir": (str, False),
+    "relay_port": (int, False),
+}
+
+
+def _check_fields(errors, prefix, values, schema):
+    for key, (types, required) in schema.items():
+        value = values.get(key)
+        # YAML中留空的项为None
+        if value is None:
+            if required:
+                errors.append(f"缺少{prefix}{key}")
+            continue
+        # bool是int的子类，数值项不接受True/False
+        if isinstance(value, bool) and bool not in (
+            types if isinstance(types, tuple) else (types,)
+        ):
+            errors.append(f"{prefix}{key}的类型错误")
+        elif not isinstance(value, types):
+            errors.append(f"{prefix}{key}的类型错误")
+
+
+def validate(config):
+    # 返回错误列表，为空表示配置有效
+    if not isinstance(config, dict):
+        return ["配置文件内容不是映射"]
+    errors = []
+    for section, schema in SCHEMA.items():
+        values = config.get(section)
+        if values is None:
+            if section in REQUIRED_SECTIONS:
+                errors.append(f"缺少{section}")
+            continue
+        if not isinstance(values, dict):
+            errors.append(f"{section}的类型错误")
+            continue
+        _check_fields(errors, f"{section}.", values, schema)
+    clients = config.get("clients")
+    if clients is not None:
+        if not isinstance(clients, list):
+            errors.append("clients的类型错误")
+        else:
+            for i, client in enumerate(clients):
+                if not isinstance(client, dict):
+                    errors.append(f"clients[{i}]的类型错误")
+                    continue
+                _check_fields(errors, f"clients[{i}].", client, CLIENT_SCHEMA)
+    else:
+        access_info = config.get("access_info") or {}
+        for key in ("client_id", "client_key"):
+            if access_info.get(key) is None:
+                errors.append(f"缺少access_info.{key}")
+    log_level = (config.get("hath-rust") or {}).get("log_level")
+    if isinstance(log_level, int) and not 0 <= log_level <= 4:
+        errors.append("hath-rust.log_level应为0~4")
+    return errors
+
+
+def diff(old, new):
+    # 以"段.项"表示发生变化的配置，非映射的段整体比较
+    changed = set()
+    for section in set(old) | set(new):
+        a, b = old.get(section), new.get(section)
+        if isinstance(a, dict) and isinstance(b, dict):
+            for key in set(a) | set(b):
+                if a.get(key) != b.get(key):
+                    changed.add(f"{section}.{key}")
+        elif a != b:
+            changed.add(section)
+    return changed
+
+
+class Watcher:
+    # Linux下使用inotify监视配置文件所在目录（编辑器常以重命名方式保存），其他平台定时检查修改时间
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path, on_change, interval=5):
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._fd = None
+
+    def start(self):
+        self._fd = self._inotify()
+        target = self._run_inotify if self._fd is not None else self._run_poll
+        threading.Thread(target=target, name="config-watcher", daemon=True).start()
+        return self._fd is not None
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _inotify(self):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                return None
+            # IN_CREATE会在文件尚未写完时触发，新建文件写完后同样有IN_CLOSE_WRITE
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+            directory = os.path.dirname(self.path).encode()
+            if libc.inotify_add_watch(fd, directory, mask) < 0:
+                os.close(fd)
+                return None
+        except (OSError, AttributeError):
+            return None
+        return fd
+
+    def _run_inotify(self):
+        name = os.path.basename(self.path).encode()
+        try:
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select([self._fd], [], [], 1)
+                if not readable:
+                    continue
+                data = os.read(self._fd, 65536)
+                if name in self._parse(data):
+                    self.on_change()
+        finally:
+            os.close(self._fd)
+
+    @staticmethod
+    def _parse(data):
+        # struct inotify_event: wd, mask, cookie, len, name[len]
+        names = []
+        offset = 0
+        while offset + 16 <= len(data):
+            _, _, _, length = struct.unpack_from("iIII", data, offset)
+            names.append(data[offset + 16 : offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+        return names
+
+    def _run_poll(self):
+        last = self._mtime()
+        while not self._stop_event.wait(self.interval):
+            mtime = self._mtime()
+            if mtime != last:
+                last = mtime
+                self.on_change()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
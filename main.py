@@ -4,13 +4,41 @@ import os
 import re
 import sys
 import time
+import random
+import asyncio
 import socket
 import signal
 import logging
+import threading
+import selectors
 import subprocess
+import collections
 import httpx
 import yaml
-from natter import natter
+import metrics
+import tracing
+import hotreload
+from concurrent.futures import CancelledError
+from natter import (
+    natter,
+    load_json,
+    save_json,
+    StunScoreboard,
+    StageTimer,
+    ForwardRelay,
+    MappingLifetimeCalibrator,
+    STUN_SERVERS,
+    parse_server_list,
+    get_network_id,
+    get_default_route,
+    NetlinkMonitor,
+    NatPmpClient,
+)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 def load_config(config_file):
@@ -18,21 +46,74 @@ def load_config(config_file):
         return yaml.safe_load(file)
 
 
+# 从hath-rust输出中解析出的事件，line仅在错误及下线事件中保留原文
+HathRustEvent = collections.namedtuple(
+    "HathRustEvent", ("time", "kind", "code", "size", "line")
+)
+
+
 class HathRustClient:
-    def __init__(self, client_id, client_key, path):
+    # hath-rust关闭时向服务器发送下线通知前后输出的日志
+    OFFLINE_PATTERN = re.compile(rb"shut(?:ting)?[ _-]?down|client_stop", re.IGNORECASE)
+    # 访问日志沿用H@H的格式：{连接号/IP} Code=200 Bytes=123456 /h/...
+    REQUEST_PATTERN = re.compile(rb"Code=(\d{3}) Bytes=(\d+)")
+    CACHE_MISS_PATTERN = re.compile(
+        rb"cache miss|not (?:found )?in cache|proxy(?:ing)? (?:request|download)",
+        re.IGNORECASE,
+    )
+    ERROR_PATTERN = re.compile(rb"\[(?:error|fatal)\]|\bERROR\b|panicked at", re.I)
+    HATH_RUST_NAME = "hath-rust" if os.name == "posix" else "hath-rust.exe"
+    DIRS = ("cache", "data", "download", "log", "tmp")
+    EVENT_BUFFER = 1000
+    ERROR_BUFFER = 100
+    RATE_WINDOW = 60
+    # 放大管道缓冲区并整块读取，输出突增时hath-rust写日志也不会阻塞
+    PIPE_SIZE = 1 << 20
+    READ_SIZE = 1 << 16
+
+    def __init__(self, client_id, client_key, path, on_exit=None, data_path=None):
         self.client_id = client_id
         self.client_key = client_key
         self.path = path
+        # 多个客户端共用同一个hath-rust程序，数据目录各自独立
+        self.data_path = data_path or os.path.join(path, "hath")
+        self.on_exit = on_exit
+        self.process = None
+        self.port = None
+        # 客户端已下线（或尚未启动），此时可以更改端口
+        self.offline = threading.Event()
+        self.offline.set()
+        self._stopping = False
+        self._reader = None
+        # 最近的事件及按秒汇总的计数（秒, 请求数, 字节数, 错误数），均为定长环形缓冲区
+        self.events = collections.deque(maxlen=self.EVENT_BUFFER)
+        # 错误单独保留，不会被大量的访问日志挤出
+        self.errors = collections.deque(maxlen=self.ERROR_BUFFER)
+        self._rates = collections.deque(maxlen=self.RATE_WINDOW)
+        self._events_lock = threading.Lock()
+        metrics.add_collector(self._collect_rates)
         self._write_client_login()
 
     def _write_client_login(self):
-        client_login_path = os.path.join(self.path, "hath", "data")
+        client_login_path = os.path.join(self.data_path, "data")
         if not os.path.exists(client_login_path):
             os.makedirs(client_login_path)
         with open(os.path.join(client_login_path, "client_login"), "w") as f:
             content = f"{self.client_id}-{self.client_key}"
             f.write(content)
 
+    def set_key(self, client_key):
+        self.client_key = client_key
+        self._write_client_login()
+
+    def prepare(self):
+        # 与打洞同时进行，启动前提前发现缺失的程序并创建目录
+        binary = os.path.join(self.path, self.HATH_RUST_NAME)
+        if not os.access(binary, os.X_OK):
+            raise FileNotFoundError(f"找不到可执行的hath-rust：{binary}")
+        for name in self.DIRS:
+            os.makedirs(os.path.join(self.data_path, name), exist_ok=True)
+
     def start(
         self,
         log_level,
@@ -42,19 +123,18 @@ class HathRustClient:
         proxy_url,
         inner_port,
     ):
-        hath_rust_name = "hath-rust" if os.name == "posix" else "hath-rust.exe"
         cmd = [
-            os.path.join(self.path, hath_rust_name),
+            os.path.join(self.path, self.HATH_RUST_NAME),
             "--cache-dir",
-            os.path.join(self.path, "hath", "cache"),
+            os.path.join(self.data_path, "cache"),
             "--data-dir",
-            os.path.join(self.path, "hath", "data"),
+            os.path.join(self.data_path, "data"),
             "--download-dir",
-            os.path.join(self.path, "hath", "download"),
+            os.path.join(self.data_path, "download"),
             "--log-dir",
-            os.path.join(self.path, "hath", "log"),
+            os.path.join(self.data_path, "log"),
             "--temp-dir",
-            os.path.join(self.path, "hath", "tmp"),
+            os.path.join(self.data_path, "tmp"),
             "--port",
             inner_port,
         ]
@@ -66,135 +146,1286 @@ class HathRustClient:
             cmd.append(f"-{'q' * log_level}")
         if rpc_server_ip:
             cmd.extend(["--rpc-server-ip", rpc_server_ip])
-        self.process = subprocess.Popen(cmd)
-
-    def stop(self):
-        self.process.terminate()
-        time.sleep(30)
+        self._stopping = False
+        self.port = int(inner_port)
+        self.offline.clear()
+        # Windows下无法对管道使用select，stderr并入stdout后阻塞读取
+        self.process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE if os.name == "posix" else subprocess.STDOUT,
+        )
+        metrics.hath_rust_up.set(1, client=self.client_id)
+        metrics.hath_rust_started.set(time.time(), client=self.client_id)
+        self._reader = threading.Thread(
+            target=self._read_output, args=(self.process,), daemon=True
+        )
+        self._reader.start()
+        threading.Thread(target=self._watch, args=(self.process,), daemon=True).start()
 
+    def _read_output(self, process):
+        # 原样转发hath-rust的输出，同时解析为事件
+        streams = {process.stdout: sys.stdout.buffer}
+        if process.stderr is not None:
+            streams[process.stderr] = sys.stderr.buffer
+        if os.name != "posix":
+            self._read_blocking(process.stdout, streams[process.stdout])
+            return
+        selector = selectors.DefaultSelector()
+        pending = {}
+        for stream in streams:
+            self._prepare_pipe(stream)
+            selector.register(stream, selectors.EVENT_READ)
+            pending[stream] = bytearray()
+        try:
+            while pending:
+                for key, _ in selector.select():
+                    stream = key.fileobj
+                    try:
+                        data = os.read(stream.fileno(), self.READ_SIZE)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        self._ingest([pending.pop(stream)])
+                        selector.unregister(stream)
+                        stream.close()
+                        continue
+                    self._feed(streams[stream], pending[stream], data)
+        finally:
+            selector.close()
 
-def update_port(
-    ipb_member_id, ipb_pass_hash, client_id, enable_proxy, proxy_url, outer_port
-):
-    url = f"https://e-hentai.org/hentaiathome.php?cid={client_id}&act=settings"
-    cookies = {"ipb_member_id": str(ipb_member_id), "ipb_pass_hash": ipb_pass_hash}
-    proxy = proxy_url if enable_proxy else None
+    def _read_blocking(self, stream, output):
+        pending = bytearray()
+        while data := os.read(stream.fileno(), self.READ_SIZE):
+            self._feed(output, pending, data)
+        self._ingest([pending])
+        stream.close()
 
-    while True:
+    def _prepare_pipe(self, stream):
+        os.set_blocking(stream.fileno(), False)
         try:
-            html_content = httpx.get(url, cookies=cookies, proxy=proxy).text
-        except Exception as e:
-            logging.error(e)
-            continue
-        # 判断客户端是否关闭（能否更改端口）
-        if re.search(r'name="f_port".*disabled="disabled"', html_content) is None:
-            break
-        time.sleep(15)
-
-    data = {}
-    # 获取原有配置
-    matches1 = re.findall(r'name="([^"]*)" value="([^"]*)"', html_content)
-    for match in matches1:
-        data[match[0]] = match[1]
-    matches2 = re.findall(r'name="([^"]*)" checked="checked"', html_content)
-    for match in matches2:
-        data[match] = "on"
-
-    data["f_port"] = outer_port
+            fcntl.fcntl(stream.fileno(), fcntl.F_SETPIPE_SZ, self.PIPE_SIZE)
+        except (AttributeError, OSError):
+            # 保持默认的管道大小（64 KiB）
+            pass
 
-    while True:
-        try:
-            httpx.post(url, data=data, cookies=cookies, proxy=proxy)
-        except Exception as e:
-            logging.error(e)
-            continue
-        break
+    def _feed(self, output, pending, data):
+        # 按块转发，只解析完整的行，末尾不完整的部分留在pending中
+        output.write(data)
+        output.flush()
+        end = data.rfind(b"\n")
+        if end < 0:
+            pending += data
+        else:
+            lines = (pending + data[:end]).split(b"\n")
+            pending[:] = data[end + 1 :]
+            self._ingest(lines)
+        # 没有换行的输出（如以\r刷新的进度或二进制内容）超过一块时只转发不解析，缓冲区不超过两块
+        if len(pending) > self.READ_SIZE:
+            pending.clear()
+
+    def _ingest(self, lines):
+        # 每块输出只更新一次指标，避免逐行加锁
+        now = time.time()
+        events = []
+        requests = collections.Counter()
+        sent = hits = misses = errors = 0
+        for line in lines:
+            if not line:
+                continue
+            match = self.REQUEST_PATTERN.search(line)
+            if match:
+                code, size = int(match[1]), int(match[2])
+                requests[code] += 1
+                sent += size
+                events.append(HathRustEvent(now, "request", code, size, None))
+                if b"/h/" in line and 200 <= code < 300:
+                    if self.CACHE_MISS_PATTERN.search(line):
+                        misses += 1
+                    else:
+                        hits += 1
+                continue
+            if self.CACHE_MISS_PATTERN.search(line):
+                misses += 1
+                events.append(HathRustEvent(now, "cache_miss", None, None, None))
+            elif self.ERROR_PATTERN.search(line):
+                errors += 1
+                text = line.decode("utf-8", "ignore").rstrip()
+                events.append(HathRustEvent(now, "error", None, None, text))
+            if not self.offline.is_set() and self.OFFLINE_PATTERN.search(line):
+                logging.info(f"hath-rust（客户端{self.client_id}）已下线")
+                text = line.decode("utf-8", "ignore").rstrip()
+                events.append(HathRustEvent(now, "offline", None, None, text))
+                self.offline.set()
+        if not events:
+            return
+        second = int(time.monotonic())
+        with self._events_lock:
+            self.events.extend(events)
+            self.errors.extend(e for e in events if e.kind == "error")
+            if not self._rates or self._rates[-1][0] != second:
+                self._rates.append([second, 0, 0, 0])
+            bucket = self._rates[-1]
+            bucket[1] += sum(requests.values())
+            bucket[2] += sent
+            bucket[3] += errors
+        for code, count in requests.items():
+            metrics.hath_rust_requests.inc(count, client=self.client_id, code=code)
+        if sent:
+            metrics.hath_rust_sent_bytes.inc(sent, client=self.client_id)
+        if hits:
+            metrics.hath_rust_cache.inc(hits, client=self.client_id, result="hit")
+        if misses:
+            metrics.hath_rust_cache.inc(misses, client=self.client_id, result="miss")
+        if errors:
+            metrics.hath_rust_errors.inc(errors, client=self.client_id)
+
+    def _collect_rates(self):
+        since = int(time.monotonic()) - self.RATE_WINDOW
+        with self._events_lock:
+            buckets = [bucket for bucket in self._rates if bucket[0] > since]
+        totals = [sum(bucket[i] for bucket in buckets) for i in (1, 2, 3)]
+        rates = [total / self.RATE_WINDOW for total in totals]
+        metrics.hath_rust_request_rate.set(rates[0], client=self.client_id)
+        metrics.hath_rust_send_rate.set(rates[1], client=self.client_id)
+        metrics.hath_rust_error_rate.set(rates[2], client=self.client_id)
+
+    def recent(self, count=10, errors=False):
+        with self._events_lock:
+            events = list(self.errors if errors else self.events)
+        return events[-count:]
 
+    def _watch(self, process):
+        returncode = process.wait()
+        self.offline.set()
+        metrics.hath_rust_up.set(0, client=self.client_id)
+        metrics.hath_rust_exits.inc(client=self.client_id, code=returncode)
+        if self._stopping:
+            return
+        logging.error(
+            f"hath-rust（客户端{self.client_id}）意外退出，返回值：{returncode}"
+        )
+        # 等待剩余输出解析完毕，便于定位退出原因
+        self._reader.join(1)
+        for event in self.recent(5, errors=True):
+            logging.error(f"hath-rust错误日志：{event.line}")
+        if self.on_exit:
+            self.on_exit(returncode)
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def wait_ready(self, timeout):
+        # 端口可以连接即视为hath-rust已就绪
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.is_running():
+                return False
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                    return True
+            except OSError:
+                time.sleep(0.5)
+        logging.warning(f"hath-rust在{timeout}秒内未开始监听端口")
+        return False
 
-def keep_alive(outer_ip, outer_port):
-    retries = 0
-    while retries < 3:
-        time.sleep(15)
+    def stop(self, timeout=30):
+        if not self.is_running():
+            return
+        self._stopping = True
+        self.process.terminate()
         try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning(f"hath-rust未在{timeout}秒内退出，强制结束")
+            self.process.kill()
+            self.process.wait()
+
+
+class SettingsClient:
+    class UpdateFailed(Exception):
+        pass
+
+    def __init__(
+        self,
+        ipb_member_id,
+        ipb_pass_hash,
+        enable_proxy,
+        proxy_url,
+        state_path,
+        base_url="https://e-hentai.org",
+    ):
+        self.base_url = base_url
+        self.state_path = state_path
+        # 记录每个客户端最近一次提交的端口
+        self.submitted = load_json(state_path, {})
+        self._submitted_lock = threading.Lock()
+        self._timeout = 30
+        self.client = self._make_client(
+            ipb_member_id, ipb_pass_hash, enable_proxy, proxy_url
+        )
+        self._min_delay = 1
+        self._max_delay = 60
+        self._poll_interval = 15
+        self._min_poll_interval = 2
+        self._max_submits = 5
+        # 下线后按最短间隔轮询的时长，之后逐渐放宽，超过最长等待时间则放弃
+        self._unlock_window = 60
+        self._max_unlock_wait = 900
+
+    def _make_client(self, ipb_member_id, ipb_pass_hash, enable_proxy, proxy_url):
+        return httpx.Client(
+            http2=True,
+            proxy=proxy_url if enable_proxy else None,
+            cookies={
+                "ipb_member_id": str(ipb_member_id),
+                "ipb_pass_hash": ipb_pass_hash,
+            },
+            timeout=self._timeout,
+            limits=httpx.Limits(keepalive_expiry=300),
+        )
+
+    def reconfigure(self, ipb_member_id, ipb_pass_hash, enable_proxy, proxy_url):
+        # 代理或Cookie变化时只替换HTTP客户端，进行中的请求在旧客户端上完成后再关闭
+        old, self.client = self.client, self._make_client(
+            ipb_member_id, ipb_pass_hash, enable_proxy, proxy_url
+        )
+        timer = threading.Timer(self._timeout, old.close)
+        timer.daemon = True
+        timer.start()
+
+    def close(self):
+        self.client.close()
+
+    def _request(self, method, url, cancel, **kwargs):
+        # 指数退避并加入随机抖动，避免代理故障时空转
+        delay = self._min_delay
+        while not cancel.is_set():
+            start = time.monotonic()
+            with tracing.span("settings.request", method=method) as span:
+                try:
+                    response = self.client.request(method, url, **kwargs)
+                    span.set(status=response.status_code)
+                    response.raise_for_status()
+                    metrics.settings_request.observe(
+                        time.monotonic() - start, method=method, result="ok"
+                    )
+                    return response.text
+                except httpx.HTTPError as e:
+                    metrics.settings_request.observe(
+                        time.monotonic() - start, method=method, result="error"
+                    )
+                    logging.error(f"请求设置页面失败：{e}")
+            cancel.wait(random.uniform(0, delay))
+            delay = min(delay * 2, self._max_delay)
+        raise CancelledError()
+
+    @staticmethod
+    def _parse_form(html_content):
+        data = {}
+        # 获取原有配置
+        matches1 = re.findall(r'name="([^"]*)" value="([^"]*)"', html_content)
+        for match in matches1:
+            data[match[0]] = match[1]
+        matches2 = re.findall(r'name="([^"]*)" checked="checked"', html_content)
+        for match in matches2:
+            data[match] = "on"
+        return data
+
+    def _settings_url(self, client_id):
+        return f"{self.base_url}/hentaiathome.php?cid={client_id}&act=settings"
+
+    def fetch_page(self, client_id, cancel):
+        # 客户端未运行时可提前获取设置页面，同时建立到服务器（及代理）的连接
+        return self._request("GET", self._settings_url(client_id), cancel)
+
+    def update_port(self, client_id, outer_port, cancel=None, offline=None, page=None):
+        # page为客户端下线后提前获取的设置页面，可省去第一次请求
+        cancel = cancel or threading.Event()
+        url = self._settings_url(client_id)
+
+        if self.submitted.get(str(client_id)) == outer_port:
+            html_content = page or self._request("GET", url, cancel)
+            if self._parse_form(html_content).get("f_port") == outer_port:
+                logging.info(f"客户端{client_id}的端口{outer_port}未变化，无需更新")
+                return
+
+        # 确认客户端下线后立即尝试更改端口
+        with tracing.span("update_port.wait_offline"):
+            while offline is not None and not offline.wait(1):
+                if cancel.is_set():
+                    raise CancelledError()
+        html_content = page or self._request("GET", url, cancel)
+
+        # 判断客户端是否关闭（能否更改端口），已确认下线时服务器很快就会解锁，直接按最短间隔轮询
+        interval = self._poll_interval if offline is None else self._min_poll_interval
+        start = time.monotonic()
+        with tracing.span("update_port.wait_unlock"):
+            while re.search(r'name="f_port".*disabled="disabled"', html_content):
+                waited = time.monotonic() - start
+                if waited >= self._max_unlock_wait:
+                    raise SettingsClient.UpdateFailed(
+                        f"客户端{client_id}在{self._max_unlock_wait}秒内未下线，"
+                        "无法更改端口"
+                    )
+                if cancel.wait(interval):
+                    raise CancelledError()
+                if waited < self._unlock_window:
+                    interval = max(interval / 2, self._min_poll_interval)
+                else:
+                    interval = min(interval * 2, self._max_delay)
+                html_content = self._request("GET", url, cancel)
+
+        data = self._parse_form(html_content)
+        data["f_port"] = outer_port
+
+        delay = self._min_delay
+        for _ in range(self._max_submits):
+            self._request("POST", url, cancel, data=data)
+            # 确认设置页面已显示新端口
+            html_content = self._request("GET", url, cancel)
+            if self._parse_form(html_content).get("f_port") == outer_port:
+                break
+            logging.warning(f"端口{outer_port}未能生效，重新提交")
+            if cancel.wait(random.uniform(0, delay)):
+                raise CancelledError()
+            delay = min(delay * 2, self._max_delay)
+        else:
+            raise SettingsClient.UpdateFailed(
+                f"端口{outer_port}提交{self._max_submits}次后仍未生效"
+            )
+
+        logging.info(f"已更新客户端{client_id}的端口：{outer_port}")
+        # 多个客户端的更新线程共用同一个记录文件
+        with self._submitted_lock:
+            self.submitted[str(client_id)] = outer_port
+            try:
+                save_json(self.state_path, self.submitted)
+            except OSError as e:
+                logging.warning(f"保存端口记录失败：{e}")
+
+
+def hairpin_check(inner_port, outer_ip, outer_port):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(("0.0.0.0", inner_port))
+            server.listen(5)
+
             with socket.create_connection((outer_ip, outer_port), timeout=3):
-                retries = 0
-        except:
-            retries += 1
+                pass
+    except:
+        return False
+    return True
 
 
-def wait_for_network():
+def wait_for_network(probe_addr=("223.5.5.5", 80), netlink=None):
+    # 订阅了rtnetlink时，链路、地址或默认路由一有变化就立即重试
     while True:
+        since = netlink.generation if netlink else None
         try:
-            with socket.create_connection(("223.5.5.5", 80), timeout=3):
+            with socket.create_connection(probe_addr, timeout=3):
                 break
         except:
-            time.sleep(15)
+            if netlink:
+                netlink.wait(15, since)
+            else:
+                time.sleep(15)
 
 
-def main():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
+def get_route_state(probe_addr):
+    # 默认路由及本机出口地址，任一变化都会使现有映射失效
+    route = get_default_route()
+    if route is None:
+        return None
+    local_ip = None
+    try:
+        # 仅在探测地址为IP时查询，避免在此进行DNS解析；UDP的connect不发送数据
+        socket.inet_aton(probe_addr[0])
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(probe_addr)
+            local_ip = sock.getsockname()[0]
+    except OSError:
+        pass
+    return route + (local_ip,)
 
-    path = os.path.dirname(os.path.realpath(__file__))
 
-    config = load_config(os.path.join(path, "config.yaml"))
+def probe_port(outer_addr):
+    try:
+        with socket.create_connection(outer_addr, timeout=3):
+            return True
+    except:
+        return False
 
-    hathrustclient = HathRustClient(
-        config["access_info"]["client_id"],
-        config["access_info"]["client_key"],
-        path,
-    )
 
-    while True:
-        inner_port, outer_ip, outer_port, upnp = natter()
+def parse_addr(addr, default_port):
+    host, _, port = addr.partition(":")
+    return host, int(port or default_port)
+
+
+async def run_in_thread(func, *args, **kwargs):
+    # 使用守护线程执行阻塞调用，退出时无需等待其结束
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result, exception):
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def worker():
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                server.bind(("0.0.0.0", inner_port))
-                server.listen(5)
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            loop.call_soon_threadsafe(set_result, None, e)
+        else:
+            loop.call_soon_threadsafe(set_result, result, None)
 
-                with socket.create_connection((outer_ip, outer_port), timeout=3):
-                    pass
-        except:
+    # 线程以函数命名，便于在追踪文件中区分
+    name = getattr(func, "__name__", None)
+    threading.Thread(target=worker, name=name, daemon=True).start()
+    return await future
+
+
+class KeepAliveTuner:
+    # 按网络记录测得的NAT空闲映射存活时间，据此调整保活间隔
+    def __init__(self, config, state_path, network_config, on_change=None):
+        self.enable = config.get("calibrate", False)
+        self.default_interval = config.get("interval", 15)
+        self.fraction = config.get("fraction", 0.5)
+        self.max_idle = config.get("max_idle", 900)
+        self.state_path = state_path
+        self.records = load_json(state_path, {})
+        self.network_config = network_config
+        self.on_change = on_change
+        self.interval = self.default_interval
+        self._applied = False
+        self._recalibrate = False
+        self._calibrator = None
+        self._task = None
+
+    def _set_interval(self, interval):
+        if interval == self.interval:
+            return
+        logging.info(f"保活间隔：{self.interval}秒 -> {interval}秒")
+        self.interval = interval
+        if self.on_change:
+            self.on_change(interval)
+
+    def _interval_for(self, lifetime):
+        return max(5, int(lifetime * self.fraction))
+
+    def start(self):
+        # 进入服务状态后调用，当前网络已有记录时直接使用，否则在后台测量
+        if not self.enable or self._applied:
+            return
+        if self._task and not self._task.done():
+            return
+        network = get_network_id() or "default"
+        record = self.records.get(network)
+        if record and not self._recalibrate:
+            self._applied = True
+            self._set_interval(self._interval_for(record["lifetime"]))
+            return
+        self._task = asyncio.create_task(self._calibrate(network))
+
+    def on_mapping_lost(self):
+        # 映射失效时先恢复默认间隔，下次进入服务状态后重新测量
+        if not self.enable or (self._task and not self._task.done()):
+            return
+        self._applied = False
+        self._recalibrate = True
+        self._set_interval(self.default_interval)
+
+    async def _calibrate(self, network):
+        keepalive_host, keepalive_port = parse_addr(
+            self.network_config.get("keepalive_server") or "www.baidu.com:80", 80
+        )
+        self._calibrator = MappingLifetimeCalibrator(
+            parse_server_list(
+                self.network_config.get("stun_servers") or STUN_SERVERS, 3478
+            ),
+            keepalive_host,
+            keepalive_port,
+            low=5,
+            high=self.max_idle,
+        )
+        logging.info(f"开始测量NAT空闲映射存活时间（网络：{network}）")
+        with tracing.span("calibrate", track="calibrate"):
+            lifetime = await run_in_thread(self._calibrator.measure)
+        if lifetime is None:
+            logging.warning("NAT空闲映射存活时间测量中断")
+            return
+        logging.info(f"NAT空闲映射存活时间：{lifetime}秒")
+        self.records[network] = {"lifetime": lifetime, "time": int(time.time())}
+        try:
+            save_json(self.state_path, self.records)
+        except OSError as e:
+            logging.warning(f"保存测量结果失败：{e}")
+        self._applied = True
+        self._recalibrate = False
+        self._set_interval(self._interval_for(lifetime))
+
+    def stop(self):
+        if self._calibrator:
+            self._calibrator.stop()
+
+
+class State:
+    PUNCHING = "punching"
+    UPDATING = "updating"
+    STARTING = "starting"
+    SERVING = "serving"
+    RECOVERING = "recovering"
+    STOPPING = "stopping"
+
+
+def load_clients(config, path):
+    # 未配置clients时沿用access_info中的单个客户端
+    clients = config.get("clients") or [
+        {
+            "client_id": config["access_info"]["client_id"],
+            "client_key": config["access_info"]["client_key"],
+        }
+    ]
+    relay_port = (config.get("relay") or {}).get("port", 8899)
+    result = []
+    for index, client in enumerate(clients):
+        client = dict(client)
+        # 第一个客户端沿用原有的hath目录，其余客户端各自使用独立目录
+        default_dir = "hath" if index == 0 else f"hath-{client['client_id']}"
+        client["dir"] = os.path.join(path, client.get("dir") or default_dir)
+        client.setdefault("relay_port", relay_port + index)
+        result.append(client)
+    return result
+
+
+class ClientSupervisor:
+    def __init__(self, supervisor, client):
+        self.supervisor = supervisor
+        self.client_id = client["client_id"]
+        self.track = f"client {self.client_id}"
+        self.state = None
+        self.hathrustclient = HathRustClient(
+            client["client_id"],
+            client["client_key"],
+            supervisor.path,
+            on_exit=self._on_hath_rust_exit,
+            data_path=client["dir"],
+        )
+        self.relay_port = client["relay_port"]
+        self.relay = None
+        self._update_cancel = threading.Event()
+        self._timer = None
+        self._prepare_task = None
+        self._prefetch_task = None
+        self.mapping = None
+        self._alert = None
+        self._teardown_task = None
+        self._update_task = None
+        self._mapping_since = None
+        self._down_since = None
+        # 预先打好并保持的备用映射，当前映射失效时直接接替
+        self.standby = (supervisor.config.get("standby") or {}).get("enable")
+        self.spare = None
+        self._spare_task = None
+        self._promoted = None
+        self._network_changed = False
+        self._hath_rust_lock = None
+
+    @property
+    def config(self):
+        # 配置重新加载后立即使用新值
+        return self.supervisor.config
+
+    def _set_state(self, state):
+        logging.debug(f"客户端{self.client_id}状态：{self.state} -> {state}")
+        self.state = state
+
+    def _wake(self):
+        # 由natter及hath-rust的后台线程调用
+        self.supervisor.loop.call_soon_threadsafe(self._alert.set)
+
+    def _on_keepalive(self, alive):
+        if not alive:
+            self._wake()
+
+    def _on_mapping_change(self, outer_addr):
+        self._wake()
+
+    def _on_hath_rust_exit(self, returncode):
+        self._wake()
+
+    async def run_cycles(self):
+        self._alert = asyncio.Event()
+        # 配置重新加载时的重启与正常的启停互斥
+        self._hath_rust_lock = asyncio.Lock()
+        while True:
+            with tracing.span("cycle", track=self.track):
+                with tracing.span("punch", track=self.track):
+                    mapping = await self._punch()
+                if mapping is None:
+                    return
+                with tracing.span("bring_up", track=self.track):
+                    await self._bring_up(mapping)
+                self._set_state(State.SERVING)
+                if self._down_since is not None:
+                    metrics.downtime.inc(
+                        time.monotonic() - self._down_since, client=self.client_id
+                    )
+                    self._down_since = None
+                self._start_spare()
+                self.supervisor.tuner.start()
+            with tracing.span("watch", track=self.track):
+                lost = await self._watch(mapping)
+            with tracing.span("recover", track=self.track):
+                await self._recover(mapping, lost)
+
+    async def _natter(self, on_keepalive, on_mapping_change):
+        supervisor = self.supervisor
+        network_config = supervisor.network_config
+        return await run_in_thread(
+            natter,
+            supervisor.scoreboard,
+            on_keepalive,
+            on_mapping_change,
+            os.path.join(supervisor.path, "upnp_cache.json"),
+            stun_list=network_config.get("stun_servers"),
+            nat_test_list=network_config.get("nat_test_servers"),
+            keepalive_server=network_config.get("keepalive_server"),
+            ssdp_addr=network_config.get("ssdp_addr"),
+            natpmp_gateway=network_config.get("natpmp_gateway"),
+            router=supervisor.upnp_router,
+            keepalive_interval=supervisor.tuner.interval,
+        )
+
+    async def _new_mapping(self, on_keepalive, on_mapping_change, track):
+        supervisor = self.supervisor
+        if supervisor.upnp_router is None:
+            # 路由器尚未找到时逐个打洞，其余客户端直接复用第一次的扫描结果
+            async with supervisor.discovery_lock:
+                mapping = await self._natter(on_keepalive, on_mapping_change)
+                if supervisor.upnp_router is None:
+                    supervisor.upnp_router = getattr(mapping.upnp, "router", None)
+        else:
+            mapping = await self._natter(on_keepalive, on_mapping_change)
+        # NAT类型测试基于UDP，且路由器可能已转发端口，只有判定可以打洞时才跳过回环连接检查
+        punchable = mapping.nat_behavior.is_punchable()
+        if not punchable:
+            with tracing.span("hairpin_check", track=track):
+                punchable = await run_in_thread(
+                    mapping.timer.run,
+                    "hairpin_check",
+                    hairpin_check,
+                    mapping.inner_port,
+                    mapping.outer_ip,
+                    mapping.outer_port,
+                )
+        return mapping, punchable
+
+    def _start_pipeline(self):
+        # 与打洞同时进行的准备工作，到_bring_up中需要其结果时再汇合
+        self._update_cancel = threading.Event()
+        self._timer = timer = StageTimer()
+        self._prepare_task = asyncio.create_task(
+            run_in_thread(timer.run, "hath_rust.prepare", self.hathrustclient.prepare)
+        )
+        self._prefetch_task = None
+        if not self.hathrustclient.is_running():
+            # 客户端已下线，设置页面此时即可获取，同时完成TLS及代理握手
+            self._prefetch_task = asyncio.create_task(
+                run_in_thread(
+                    timer.run,
+                    "settings.prefetch",
+                    self.supervisor.settings.fetch_page,
+                    self.client_id,
+                    self._update_cancel,
+                )
+            )
+
+    async def _join_pipeline(self):
+        with tracing.span("join", track=self.track):
+            await self._prepare_task
+            page = await self._prefetch_task if self._prefetch_task else None
+        elapsed, serial = self._timer.elapsed(), self._timer.serial()
+        logging.info(
+            f"客户端{self.client_id}准备用时{elapsed:.2f}秒，"
+            f"逐步执行需{serial:.2f}秒，节省{serial - elapsed:.2f}秒"
+        )
+        tracing.instant("pipeline", track=self.track, elapsed=elapsed, serial=serial)
+        return page
+
+    async def _punch(self):
+        self._set_state(State.PUNCHING)
+        self._alert.clear()
+        self._network_changed = False
+        self._start_pipeline()
+        mapping, self._promoted = self._promoted, None
+        if mapping:
+            # 备用映射已验证过，改由当前客户端接收其状态通知
+            mapping.keepalive.on_status = self._on_keepalive
+            mapping.monitor.on_change = self._on_mapping_change
+            logging.info(
+                f"客户端{self.client_id}切换至备用映射"
+                f"{mapping.outer_ip}:{mapping.outer_port}"
+            )
+            metrics.standby_promotions.inc(client=self.client_id)
+            tracing.instant("standby.promote", track=self.track)
+            self.mapping = mapping
+            self._mapping_since = time.monotonic()
+            return mapping
+        # 旧hath-rust的关闭与新一轮打洞同时进行
+        mapping, punchable = await self._new_mapping(
+            self._on_keepalive, self._on_mapping_change, self.track
+        )
+        self._timer.merge(mapping.timer)
+        self.mapping = mapping
+        self._mapping_since = time.monotonic()
+        if not punchable:
             logging.error("打洞失败，请检查NAT类型")
-            upnp.clear()
-            sys.exit(0)
+            return None
+        return mapping
+
+    def _start_spare(self):
+        if not self.standby or self.spare:
+            return
+        if self._spare_task and not self._spare_task.done():
+            return
+        self._spare_task = asyncio.create_task(self._build_spare())
+
+    async def _build_spare(self):
+        # 在关键路径之外进行，失败时仅记录日志，下次恢复后再重试
+        track = f"{self.track} standby"
+        with tracing.span("standby.build", track=track):
+            await self.supervisor.wait_for_network()
+            holder = []
+
+            def on_keepalive(alive):
+                if not alive:
+                    self._spare_lost(holder)
+
+            try:
+                mapping, punchable = await self._new_mapping(
+                    on_keepalive, lambda outer_addr: self._spare_lost(holder), track
+                )
+            except Exception as e:
+                logging.warning(f"客户端{self.client_id}备用映射建立失败：{e}")
+                return
+            if not punchable:
+                await run_in_thread(mapping.close)
+                return
+            holder.append(mapping)
+            self.spare = mapping
+        logging.info(
+            f"客户端{self.client_id}备用映射已就绪："
+            f"{mapping.outer_ip}:{mapping.outer_port}"
+        )
+
+    def _spare_lost(self, holder):
+        # 由备用映射的保活及监视线程调用
+        self.supervisor.loop.call_soon_threadsafe(self._discard_spare, holder)
+
+    def _discard_spare(self, holder):
+        if not holder or self.spare is not holder[0]:
+            return
+        logging.warning(f"客户端{self.client_id}备用映射已失效，重新建立")
+        self._drop_spare()
+        # 当前映射同时失效时，恢复完成后再重建，以免与打洞争抢
+        if self.state == State.SERVING and not self._alert.is_set():
+            self._start_spare()
+
+    def _drop_spare(self):
+        mapping, self.spare = self.spare, None
+        if mapping:
+            threading.Thread(target=mapping.close, daemon=True).start()
+
+    def _take_spare(self):
+        mapping = self.spare
+        if mapping is None:
+            return None
+        # 保活连接正常且外部地址未变化才可接替
+        outer_addr = (mapping.outer_ip, mapping.outer_port)
+        if mapping.keepalive.alive and mapping.monitor.outer_addr == outer_addr:
+            self.spare = None
+            return mapping
+        self._drop_spare()
+        return None
+
+    def on_network_change(self):
+        # 默认路由或本机地址变化后，当前映射及备用映射均已失效
+        self._drop_spare()
+        if self.state == State.SERVING:
+            self._network_changed = True
+            self._alert.set()
+
+    async def _bring_up(self, mapping):
+        self._set_state(State.UPDATING)
+        hath_port = mapping.inner_port
+        if self.supervisor.relay_config.get("enable"):
+            hath_port = self.relay_port
+            relay = ForwardRelay(mapping.inner_port, "127.0.0.1", hath_port)
+            relay.start()
+            # 旧连接继续由旧转发处理直至结束
+            if self.relay:
+                self.relay.close()
+            self.relay = relay
+
+        # 客户端下线后才能更改端口，无需等待hath-rust完全退出
+        outer_port = str(mapping.outer_port)
+        relaying = self.relay and self.hathrustclient.is_running()
+        stopping = None
+        if (
+            relaying
+            and self.supervisor.settings.submitted.get(str(self.client_id))
+            != outer_port
+        ):
+            # 客户端在线时设置页面不允许更改端口，短暂停止hath-rust，重启后仍监听固定的转发端口
+            relaying = False
+            stopping = asyncio.create_task(
+                self._stop_hath_rust(f"{self.track} teardown")
+            )
+        page = await self._join_pipeline()
+        self._update_task = asyncio.create_task(
+            run_in_thread(
+                self._update_port,
+                outer_port,
+                self._update_cancel,
+                None if relaying else self.hathrustclient.offline,
+                page,
+            )
+        )
+        if relaying:
+            # 外部端口未变化时hath-rust无需重启，在后台确认设置页面
+            return
+        with tracing.span("update_port", track=self.track):
+            await self._update_task
+        for task in (self._teardown_task, stopping):
+            if task:
+                with tracing.span("teardown", track=self.track):
+                    await task
+        self._teardown_task = None
+
+        self._set_state(State.STARTING)
+        async with self._hath_rust_lock:
+            await self._start_hath_rust(hath_port)
+
+    async def _start_hath_rust(self, hath_port):
+        with tracing.span("hath_rust.start", track=self.track):
+            self.hathrustclient.start(
+                self.config["hath-rust"]["log_level"],
+                self.config["hath-rust"]["force_background_scan"],
+                self.config["hath-rust"]["rpc_server_ip"],
+                self.config["proxy"]["cache_download"],
+                self.config["proxy"]["url"],
+                str(hath_port),
+            )
+        with tracing.span("hath_rust.wait_ready", track=self.track):
+            ready = await run_in_thread(
+                self.hathrustclient.wait_ready, self.supervisor.ready_timeout
+            )
+        if ready:
+            logging.info(f"hath-rust（客户端{self.client_id}）已就绪")
+
+    async def restart_hath_rust(self):
+        # 仅重启hath-rust，映射、UPnP规则及端口均保持不变
+        async with self._hath_rust_lock:
+            if self.state != State.SERVING or not self.hathrustclient.is_running():
+                # 下次启动时自然使用新配置
+                return
+            logging.info(f"配置已变化，重启hath-rust（客户端{self.client_id}）")
+            hath_port = self.hathrustclient.port
+            with tracing.span("hath_rust.restart", track=self.track):
+                await run_in_thread(
+                    self.hathrustclient.stop, self.supervisor.stop_timeout
+                )
+                await self._start_hath_rust(hath_port)
+
+    async def _watch(self, mapping):
+        # 返回映射是否失效，hath-rust自行退出时返回False
+        outer_addr = (mapping.outer_ip, mapping.outer_port)
+        retries = 0
+        # 仅放宽保活间隔；检测间隔保持默认值，直连模式下它是唯一能发现映射失效的方式
+        while retries < 3:
+            # 保活连接断开、映射变化或hath-rust退出时立即检查，无需等待下一轮
+            try:
+                await asyncio.wait_for(
+                    self._alert.wait(), self.supervisor.tuner.default_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            else:
+                self._alert.clear()
+                if self._network_changed:
+                    return True
+                if mapping.monitor.outer_addr != outer_addr:
+                    return True
+                if not self.hathrustclient.is_running():
+                    return False
+                retries = 2
+            if await run_in_thread(probe_port, outer_addr):
+                retries = 0
+            else:
+                retries += 1
+        return self.hathrustclient.is_running()
+
+    def _update_port(self, outer_port, cancel, offline, page=None):
+        start = time.monotonic()
+        result = "error"
+        try:
+            with tracing.span("settings.update_port", port=outer_port):
+                self.supervisor.settings.update_port(
+                    self.client_id, outer_port, cancel, offline, page
+                )
+            result = "ok"
+        except SettingsClient.UpdateFailed as e:
+            # hath-rust照常启动，端口不可用时会退出并触发重新打洞
+            logging.error(f"客户端{self.client_id}更新端口失败：{e}")
+        except CancelledError:
+            result = "cancelled"
+            raise
+        finally:
+            metrics.update_port.observe(
+                time.monotonic() - start, client=self.client_id, result=result
+            )
+
+    def cancel_update(self):
+        # 同时通知后台线程停止，以免之后提交过期的端口
+        self._update_cancel.set()
+        if self._update_task and not self._update_task.done():
+            self._update_task.cancel()
 
-        update_port(
+    async def _recover(self, mapping, lost=True):
+        self._set_state(State.RECOVERING)
+        if lost:
+            self.supervisor.tuner.on_mapping_lost()
+        logging.info(f"客户端{self.client_id}连接断开，即将重新启动")
+        self._down_since = time.monotonic()
+        metrics.restarts.inc(client=self.client_id)
+        metrics.mapping_lifetime.observe(
+            self._down_since - self._mapping_since, client=self.client_id
+        )
+        if not self.supervisor.metrics_server:
+            logging.info(f"运行统计：{metrics.summary()}")
+        mapping.monitor.stop()
+        mapping.keepalive.stop()
+        self.cancel_update()
+        # 有可用的备用映射时直接接替，打洞及等待网络都不在关键路径上
+        self._promoted = self._take_spare()
+        if self._promoted is None:
+            # 映射失效可能是路由器重启，下次打洞重新确认路由器
+            self.supervisor.upnp_router = None
+            with tracing.span("wait_for_network", track=self.track):
+                await self.supervisor.wait_for_network()
+        self._teardown_task = asyncio.create_task(self._teardown(mapping))
+
+    async def _teardown(self, mapping):
+        # 与新一轮打洞并行，单独放在一条轨道上
+        track = f"{self.track} teardown"
+        with tracing.span("port_mapping.clear", track=track):
+            await run_in_thread(mapping.upnp.clear)
+        if not self.relay:
+            await self._stop_hath_rust(track)
+
+    async def _stop_hath_rust(self, track):
+        async with self._hath_rust_lock:
+            with tracing.span("hath_rust.stop", track=track):
+                await run_in_thread(
+                    self.hathrustclient.stop, self.supervisor.stop_timeout
+                )
+
+    async def shutdown(self):
+        self._set_state(State.STOPPING)
+        if self._spare_task and not self._spare_task.done():
+            # 打洞在线程中进行，取消后其建立的映射无人关闭，因此先等待其完成
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(self._spare_task), self.supervisor.stop_timeout
+                )
+            except asyncio.TimeoutError:
+                self._spare_task.cancel()
+        if self.spare:
+            await run_in_thread(self.spare.close)
+        if self.mapping:
+            await run_in_thread(self.mapping.close)
+        if self.relay:
+            self.relay.close(drain=False)
+        await run_in_thread(self.hathrustclient.stop, self.supervisor.stop_timeout)
+
+
+class Supervisor:
+    # 管理全部客户端，STUN记分、UPnP路由器及设置页面的HTTP会话由各客户端共享
+    def __init__(self, config, path, config_file=None):
+        self.config = config
+        self.path = path
+        # 指定配置文件时监视其变化并重新加载
+        self.config_file = config_file
+        self.config_watcher = None
+        self._restart_tasks = set()
+        # 出错或无法打洞而停止的客户端
+        self._failed = set()
+        self.stop_timeout = config["hath-rust"].get("stop_timeout", 30)
+        self.ready_timeout = config["hath-rust"].get("ready_timeout", 120)
+        # STUN服务器的历史表现，用于决定探测顺序
+        self.scoreboard = StunScoreboard(os.path.join(path, "stun_scoreboard.json"))
+        # 转发模式下hath-rust固定监听relay端口，重新打洞时无需重启
+        self.relay_config = config.get("relay") or {}
+        # 测试或特殊网络环境下可替换默认的STUN、保活及探测服务器
+        self.network_config = config.get("network") or {}
+        self.probe_addr = parse_addr(
+            self.network_config.get("probe_server") or "223.5.5.5:80", 80
+        )
+        self.settings = SettingsClient(
             config["access_info"]["ipb_member_id"],
             config["access_info"]["ipb_pass_hash"],
-            config["access_info"]["client_id"],
             config["proxy"]["enable"],
             config["proxy"]["url"],
-            str(outer_port),
+            os.path.join(path, "port_state.json"),
+            self.network_config.get("settings_url") or "https://e-hentai.org",
+        )
+        # 保活间隔，启用测量后按NAT空闲映射的存活时间调整
+        self.tuner = KeepAliveTuner(
+            config.get("keepalive") or {},
+            os.path.join(path, "nat_lifetime.json"),
+            self.network_config,
+            on_change=self._apply_keepalive_interval,
         )
+        # Linux下订阅网络变化，其他平台仅依靠定时探测
+        self.netlink = None
+        self._route_state = None
+        self.upnp_router = None
+        self.discovery_lock = None
+        self.loop = None
+        self._stop_event = None
+        # 未启用指标服务时，每次重启都在日志中输出统计
+        self.metrics_config = config.get("metrics") or {}
+        self.metrics_server = None
+        # 环境变量HATH_TRACE优先于配置文件
+        tracing_config = config.get("tracing") or {}
+        self.trace_path = os.environ.get("HATH_TRACE")
+        if not self.trace_path and tracing_config.get("enable"):
+            self.trace_path = os.path.join(
+                path, tracing_config.get("path") or "trace.json"
+            )
+        self.clients = [
+            ClientSupervisor(self, client) for client in load_clients(config, path)
+        ]
 
-        hathrustclient.start(
-            config["hath-rust"]["log_level"],
-            config["hath-rust"]["force_background_scan"],
-            config["hath-rust"]["rpc_server_ip"],
-            config["proxy"]["cache_download"],
-            config["proxy"]["url"],
-            str(inner_port),
+    def _install_signal_handlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self.loop.add_signal_handler(signum, self._stop_event.set)
+            except NotImplementedError:
+                # Windows下的事件循环不支持add_signal_handler
+                signal.signal(
+                    signum,
+                    lambda *_: self.loop.call_soon_threadsafe(self._stop_event.set),
+                )
+
+    async def wait_for_network(self):
+        await run_in_thread(wait_for_network, self.probe_addr, self.netlink)
+
+    def _start_netlink(self):
+        netlink = NetlinkMonitor(on_event=self._on_network_event)
+        if not netlink.start():
+            return
+        self.netlink = netlink
+        self._route_state = get_route_state(self.probe_addr)
+        logging.info("已订阅网络变化通知")
+
+    def _on_network_event(self, kinds):
+        # 由rtnetlink线程调用；网络断开时交由保活及wait_for_network处理
+        state = get_route_state(self.probe_addr)
+        if state is None or state == self._route_state:
+            return
+        old, self._route_state = self._route_state, state
+        if old is None:
+            return
+        logging.warning(f"网络已变化：{old} -> {state}，重新打洞")
+        self.loop.call_soon_threadsafe(self._network_changed)
+
+    def _network_changed(self):
+        tracing.instant("network_change", track="supervisor")
+        NatPmpClient.invalidate()
+        for client in self.clients:
+            client.on_network_change()
+
+    def _start_config_watcher(self):
+        self.config_watcher = hotreload.Watcher(
+            self.config_file, self._on_config_file_change
         )
+        self.config_watcher.start()
+
+    def _on_config_file_change(self):
+        # 由监视线程调用，配置无效时保持当前配置
+        try:
+            config = load_config(self.config_file)
+        except (OSError, yaml.YAMLError) as e:
+            logging.error(f"读取配置文件失败：{e}")
+            return
+        errors = hotreload.validate(config)
+        if errors:
+            logging.error(f"配置文件无效，未重新加载：{'；'.join(errors)}")
+            return
+        self.loop.call_soon_threadsafe(self._reload_config, config)
+
+    def _reload_config(self, config):
+        changed = hotreload.diff(self.config, config)
+        if not changed:
+            return
+        self.config = config
+        logging.info(f"配置已重新加载：{'，'.join(sorted(changed))}")
+        tracing.instant("config.reload", track="supervisor", changed=sorted(changed))
+        applied = set()
+
+        hath_rust_config = config["hath-rust"]
+        self.stop_timeout = hath_rust_config.get("stop_timeout", 30)
+        self.ready_timeout = hath_rust_config.get("ready_timeout", 120)
+        applied |= {"hath-rust.stop_timeout", "hath-rust.ready_timeout"}
+
+        # 设置页面的Cookie及代理：只替换HTTP客户端
+        http_keys = {
+            "access_info.ipb_member_id",
+            "access_info.ipb_pass_hash",
+            "proxy.enable",
+            "proxy.url",
+        }
+        if changed & http_keys:
+            self.settings.reconfigure(
+                config["access_info"]["ipb_member_id"],
+                config["access_info"]["ipb_pass_hash"],
+                config["proxy"]["enable"],
+                config["proxy"]["url"],
+            )
+        applied |= http_keys
 
-        def signal_handler(signum, frame):
-            upnp.clear()
-            hathrustclient.stop()
-            sys.exit(0)
+        # 仅以下参数需要重启hath-rust；代理地址只在代理下载缓存时传给hath-rust
+        restart_keys = {
+            "hath-rust.log_level",
+            "hath-rust.force_background_scan",
+            "hath-rust.rpc_server_ip",
+            "proxy.cache_download",
+        }
+        restart = bool(changed & restart_keys)
+        if "proxy.url" in changed and config["proxy"]["cache_download"]:
+            restart = True
+        applied |= restart_keys
 
-        signal.signal(signal.SIGTERM, signal_handler)
+        restart_clients = set()
+        client_keys = {"access_info.client_id", "access_info.client_key", "clients"}
+        if changed & client_keys:
+            clients = load_clients(config, self.path)
+            same = [(c["client_id"], c["dir"]) for c in clients] == [
+                (c.client_id, c.hathrustclient.data_path) for c in self.clients
+            ]
+            if same:
+                for c, client in zip(clients, self.clients):
+                    if c["client_key"] != client.hathrustclient.client_key:
+                        client.hathrustclient.set_key(c["client_key"])
+                        restart_clients.add(client)
+                applied |= client_keys
+            else:
+                # 增减客户端或更换ID、目录需重新打洞，不在此处理
+                logging.warning("客户端列表已变化，需重启程序后生效")
+
+        for client in self.clients:
+            if restart or client in restart_clients:
+                task = asyncio.create_task(client.restart_hath_rust())
+                self._restart_tasks.add(task)
+                task.add_done_callback(self._restart_tasks.discard)
+
+        pending = changed - applied
+        if pending:
+            logging.warning(f"以下配置需重启程序后生效：{'，'.join(sorted(pending))}")
+
+    def _apply_keepalive_interval(self, interval):
+        for client in self.clients:
+            for mapping in (client.mapping, client.spare):
+                if mapping:
+                    mapping.keepalive.interval = interval
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self.discovery_lock = asyncio.Lock()
+        self._install_signal_handlers()
+        self._start_netlink()
+        if self.config_file:
+            self._start_config_watcher()
+        if self.metrics_config.get("enable"):
+            self.metrics_server = metrics.start_server(
+                self.metrics_config.get("host", "127.0.0.1"),
+                self.metrics_config.get("port", 9110),
+            )
+        if self.trace_path:
+            tracing.enable(self.trace_path)
+
+        # 某个客户端打洞失败时，其余客户端继续运行
+        cycles = asyncio.gather(*(self._run_client(client) for client in self.clients))
+        stopping = asyncio.create_task(self._stop_event.wait())
+        await asyncio.wait({cycles, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        for client in self.clients:
+            client.cancel_update()
+        for task in (cycles, stopping):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(cycles, stopping, return_exceptions=True)
+        await self._shutdown()
+        return 1 if self._failed else 0
+
+    async def _run_client(self, client):
+        # run_cycles仅在无法继续时返回
+        try:
+            await client.run_cycles()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception(f"客户端{client.client_id}运行出错")
+        logging.error(f"客户端{client.client_id}已停止")
+        self._failed.add(client.client_id)
+        # 立即释放保活连接、端口转发及hath-rust，其余客户端不受影响
+        try:
+            await client.shutdown()
+        except Exception:
+            logging.exception(f"客户端{client.client_id}停止时出错")
+
+    async def _shutdown(self):
+        if self.config_watcher:
+            self.config_watcher.stop()
+        self.tuner.stop()
+        if self.netlink:
+            self.netlink.stop()
+        await asyncio.gather(
+            *(
+                client.shutdown()
+                for client in self.clients
+                if client.client_id not in self._failed
+            )
+        )
+        self.settings.close()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+        tracing.close()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    path = os.path.dirname(os.path.realpath(__file__))
 
-        time.sleep(60)
-        keep_alive(outer_ip, outer_port)
+    config_file = os.path.join(path, "config.yaml")
+    config = load_config(config_file)
+    # 启动时仅提示，不阻止运行
+    for error in hotreload.validate(config):
+        logging.warning(f"配置文件：{error}")
 
-        logging.info("连接断开，即将重新启动")
-        wait_for_network()
-        upnp.clear()
-        hathrustclient.stop()
+    sys.exit(asyncio.run(Supervisor(config, path, config_file).run()))
 
 
 if __name__ == "__main__":
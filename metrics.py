@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import math
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 默认分桶（秒），覆盖STUN往返到hath-rust重启的时间范围
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+LIFETIME_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 21600, 43200, 86400, 604800)
+
+_registry = []
+_collectors = []  # 导出前调用，用于刷新按需计算的指标
+_lock = threading.Lock()
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        # 无标签的指标从0开始导出，便于计算增长率
+        if not self.labelnames:
+            self._values[()] = self._initial()
+        with _lock:
+            _registry.append(self)
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}的标签应为{self.labelnames}")
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with _lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+
+    def _initial(self):
+        return [0] * len(self.buckets), 0
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            counts, total = self._values.get(key) or self._initial()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self):
+        return sum(sum(counts) for counts, _ in self._values.values())
+
+    def _samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames, key, (("le", _format_value(bound)),)
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def add_collector(func):
+    with _lock:
+        _collectors.append(func)
+
+
+def render():
+    with _lock:
+        metrics = list(_registry)
+        collectors = list(_collectors)
+    for collector in collectors:
+        collector()
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host, port):
+    # 绑定失败时返回None，由调用方改用日志输出
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logging.error(f"指标服务监听{host}:{port}失败：{e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"指标服务已启动：http://{host}:{port}/metrics")
+    return server
+
+
+stun_latency = Histogram("natter_stun_latency_seconds", "STUN请求往返时间", ("server",))
+stun_failures = Counter("natter_stun_failures_total", "STUN请求失败次数", ("server",))
+upnp_discovery = Histogram(
+    "natter_upnp_discovery_seconds", "UPnP路由器发现耗时", ("result",)
+)
+mapping_lifetime = Histogram(
+    "natter_mapping_lifetime_seconds",
+    "打洞映射从建立到失效的时长",
+    ("client",),
+    buckets=LIFETIME_BUCKETS,
+)
+standby_promotions = Counter(
+    "hath_standby_promotions_total", "由备用映射直接接替的次数", ("client",)
+)
+restarts = Counter("hath_restarts_total", "连接断开后重新启动的次数", ("client",))
+downtime = Counter(
+    "hath_downtime_seconds_total", "重新启动期间累计的不可用时长", ("client",)
+)
+settings_request = Histogram(
+    "hath_settings_request_seconds",
+    "设置页面单次请求耗时",
+    ("method", "result"),
+)
+update_port = Histogram(
+    "hath_update_port_seconds", "更新端口的总耗时", ("client", "result")
+)
+hath_rust_exits = Counter(
+    "hath_rust_exits_total", "hath-rust退出次数（按返回值）", ("client", "code")
+)
+hath_rust_up = Gauge("hath_rust_up", "hath-rust是否正在运行", ("client",))
+# 运行时长即 time() - hath_rust_start_time_seconds
+hath_rust_started = Gauge(
+    "hath_rust_start_time_seconds",
+    "hath-rust最近一次启动的时间（Unix时间）",
+    ("client",),
+)
+hath_rust_requests = Counter(
+    "hath_rust_requests_total", "hath-rust处理的请求数（按状态码）", ("client", "code")
+)
+hath_rust_sent_bytes = Counter(
+    "hath_rust_sent_bytes_total", "hath-rust发送的文件字节数", ("client",)
+)
+hath_rust_cache = Counter(
+    "hath_rust_cache_total", "hath-rust缓存命中与未命中次数", ("client", "result")
+)
+hath_rust_errors = Counter(
+    "hath_rust_errors_total", "hath-rust输出的错误日志条数", ("client",)
+)
+# 以下为最近一分钟的平均值，导出时根据hath-rust输出计算
+hath_rust_request_rate = Gauge(
+    "hath_rust_request_rate", "hath-rust每秒处理的请求数", ("client",)
+)
+hath_rust_send_rate = Gauge(
+    "hath_rust_send_rate_bytes", "hath-rust每秒发送的字节数", ("client",)
+)
+hath_rust_error_rate = Gauge(
+    "hath_rust_error_rate", "hath-rust每秒输出的错误日志条数", ("client",)
+)
+
+
+def summary():
+    # 未启用指标服务时，以日志形式输出关键指标
+    return (
+        f"重启{restarts.total():.0f}次，"
+        f"累计中断{downtime.total():.0f}秒，"
+        f"映射失效{mapping_lifetime.count()}次，"
+        f"备用映射接替{standby_promotions.total():.0f}次，"
+        f"hath-rust退出{hath_rust_exits.total():.0f}次，"
+        f"处理请求{hath_rust_requests.total():.0f}次，"
+        f"错误日志{hath_rust_errors.total():.0f}条，"
+        f"STUN失败{stun_failures.total():.0f}次"
+    )
@@ -21,14 +21,39 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import re
 import sys
+import json
 import time
 import random
 import socket
+import queue
+import select
 import struct
 import logging
+import threading
+import contextlib
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import metrics
+except ImportError:
+    metrics = None
+
+try:
+    import tracing
+except ImportError:
+    tracing = None
 
 __version__ = "2.1.1"
 
+HTTP_MAX_HEADER = 16384
+HTTP_MAX_BODY = 1 << 20
+
 
 logging.basicConfig(
     level=logging.INFO,
@@ -37,16 +62,159 @@ logging.basicConfig(
 )
 
 
+def trace_span(name, **args):
+    # a no-op without the tracing module, e.g. when natter.py runs alone
+    if tracing is None:
+        return contextlib.nullcontext()
+    return tracing.span(name, **args)
+
+
+class DnsCache(object):
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._cache = {}  # hostname => (expire_time, ipaddr)
+        self._lock = threading.Lock()
+
+    def resolve(self, hostname):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(hostname)
+        if entry and entry[0] > now:
+            return entry[1]
+        ipaddr = socket.gethostbyname(hostname)
+        with self._lock:
+            self._cache[hostname] = (now + self.ttl, ipaddr)
+        logging.debug("dns: Resolved %s to %s" % (hostname, ipaddr))
+        return ipaddr
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+dns_cache = DnsCache()
+
+
+class StunScoreboard(object):
+    def __init__(self, path=None, alpha=0.3, quarantine_after=3, quarantine_time=600):
+        self.path = path
+        self.alpha = alpha
+        self.quarantine_after = quarantine_after
+        self.quarantine_time = quarantine_time
+        self._default_rtt = 0.5
+        self._scores = {}  # "host:port" => {ok, fail, rtt, streak, until}
+        self._lock = threading.Lock()
+        if path:
+            self._scores = load_json(path, {})
+
+    def record(self, server, ok, rtt=None):
+        key = addr_to_str(server)
+        with self._lock:
+            score = self._scores.setdefault(
+                key, {"ok": 0, "fail": 0, "rtt": None, "streak": 0, "until": 0}
+            )
+            if ok:
+                score["ok"] += 1
+                score["streak"] = 0
+                score["until"] = 0
+                if rtt is not None:
+                    if score["rtt"] is None:
+                        score["rtt"] = rtt
+                    else:
+                        score["rtt"] += self.alpha * (rtt - score["rtt"])
+            else:
+                score["fail"] += 1
+                score["streak"] += 1
+                if (
+                    score["streak"] >= self.quarantine_after
+                    and score["until"] <= time.time()
+                ):
+                    score["until"] = time.time() + self.quarantine_time
+                    logging.info(
+                        "stun: STUN server %s is quarantined for %d seconds"
+                        % (addr_to_uri(server), self.quarantine_time)
+                    )
+
+    def success_rate(self, server):
+        score = self._scores.get(addr_to_str(server))
+        if not score:
+            return 0.5
+        return (score["ok"] + 1.0) / (score["ok"] + score["fail"] + 2.0)
+
+    def is_quarantined(self, server):
+        score = self._scores.get(addr_to_str(server))
+        return bool(score) and score["until"] > time.time()
+
+    def order(self, servers):
+        def cost(server):
+            score = self._scores.get(addr_to_str(server)) or {}
+            rtt = score.get("rtt") or self._default_rtt
+            return rtt / self.success_rate(server)
+
+        with self._lock:
+            healthy = [s for s in servers if not self.is_quarantined(s)]
+            quarantined = [s for s in servers if self.is_quarantined(s)]
+            healthy.sort(key=cost)
+        # quarantined servers are kept as the last resort only
+        return healthy + quarantined
+
+    def concurrency(self, servers, quorum, limit):
+        # probe just enough servers to expect a quorum of answers
+        expected = 0.0
+        count = 0
+        with self._lock:
+            for server in servers:
+                if self.is_quarantined(server):
+                    continue
+                expected += self.success_rate(server)
+                count += 1
+                if expected >= quorum:
+                    break
+        return max(quorum, min(count, limit))
+
+    def save(self):
+        if not self.path:
+            return
+        # one scoreboard may be shared by several natter() calls, and they
+        # all write through the same temporary file
+        with self._lock:
+            try:
+                save_json(self.path, self._scores)
+            except (OSError, socket.error) as ex:
+                logging.warning("stun: failed to save scoreboard: %s" % ex)
+
+
 class StunClient(object):
     class ServerUnavailable(Exception):
         pass
 
-    def __init__(self, stun_server_list):
+    class SourcePortBusy(ServerUnavailable):
+        pass
+
+    def __init__(self, stun_server_list, concurrency=1, quorum=2, scoreboard=None):
         self.stun_server_list = stun_server_list
         self.source_host = "0.0.0.0"
         self.source_port = 0
+        self.concurrency = concurrency
+        self.quorum = quorum
+        self.scoreboard = scoreboard
+        self._inflight = set()
+        self._cancelled = set()
+        self._inflight_lock = threading.Lock()
 
     def get_mapping(self):
+        with trace_span("stun.get_mapping"):
+            if not self.scoreboard:
+                return self._get_mapping_loop()
+            self.stun_server_list = self.scoreboard.order(self.stun_server_list)
+            try:
+                return self._get_mapping_loop()
+            finally:
+                self.scoreboard.save()
+
+    def _get_mapping_loop(self):
+        if self.concurrency > 1:
+            return self._get_mapping_concurrent()
         first = self.stun_server_list[0]
         while True:
             try:
@@ -62,95 +230,1083 @@ class StunClient(object):
                     # force sleep for 10 seconds, then try the next loop
                     time.sleep(10)
 
-    def _get_mapping(self):
-        # ref: https://www.rfc-editor.org/rfc/rfc5389
-        socket_type = socket.SOCK_STREAM
-        stun_host, stun_port = self.stun_server_list[0]
-        sock = socket.socket(socket.AF_INET, socket_type)
-        socket_set_opt(
-            sock,
-            reuse=True,
-            bind_addr=(self.source_host, self.source_port),
-            timeout=3,
-        )
+    def _get_mapping_concurrent(self):
+        while True:
+            # hold the source port, so that all racing sockets share it
+            anchor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                socket_set_opt(
+                    anchor,
+                    reuse=True,
+                    bind_addr=(self.source_host, self.source_port),
+                )
+                self.source_port = anchor.getsockname()[1]
+                result = self._race()
+            finally:
+                anchor.close()
+            if result:
+                return result
+            logging.error("stun: No STUN server is available right now")
+            # force sleep for 10 seconds, then try the next loop
+            time.sleep(10)
+
+    def _race(self):
+        servers = list(self.stun_server_list)
+        reserve = []
+        concurrency = self.concurrency
+        if self.scoreboard:
+            concurrency = self.scoreboard.concurrency(
+                servers, self.quorum, self.concurrency
+            )
+            reserve = [s for s in servers if self.scoreboard.is_quarantined(s)]
+            servers = [s for s in servers if s not in reserve]
+        pending = {}  # future => server
+        answers = {}  # outer_addr => [server, ...]
+        first = None
+        executor = ThreadPoolExecutor(max_workers=concurrency)
         try:
-            sock.connect((stun_host, stun_port))
-            inner_addr = sock.getsockname()
-            self.source_host, self.source_port = inner_addr
-            sock.send(
-                struct.pack(
-                    "!LLLLL",
-                    0x00010000,
-                    0x2112A442,
-                    0x4E415452,
-                    random.getrandbits(32),
-                    random.getrandbits(32),
+            while servers or pending or reserve:
+                if not servers and not pending:
+                    # quarantined servers are probed only as the last resort
+                    servers, reserve = reserve, []
+                while servers and len(pending) < concurrency:
+                    server = servers.pop(0)
+                    pending[executor.submit(self._get_mapping, server)] = server
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    server = pending.pop(fut)
+                    try:
+                        inner_addr, outer_addr = fut.result()
+                    except StunClient.ServerUnavailable as ex:
+                        logging.warning(
+                            "stun: STUN server %s is unavailable: %s"
+                            % (addr_to_uri(server), ex)
+                        )
+                        continue
+                    if first is None:
+                        first = inner_addr, outer_addr
+                    agreed = answers.setdefault(outer_addr, [])
+                    agreed.append(server)
+                    if len(agreed) >= self.quorum:
+                        logging.debug(
+                            "stun: Address %s confirmed by %s"
+                            % (addr_to_uri(outer_addr), agreed)
+                        )
+                        return inner_addr, outer_addr
+            if first and len(answers) > 1:
+                logging.warning(
+                    "stun: STUN servers disagree on the mapped address: %s"
+                    % (list(answers),)
                 )
+            elif first:
+                logging.warning(
+                    "stun: Address %s is not confirmed by another server"
+                    % addr_to_uri(first[1])
+                )
+            return first
+        finally:
+            for fut in pending:
+                fut.cancel()
+            self._cancel_inflight()
+            executor.shutdown(wait=False)
+
+    def _cancel_inflight(self):
+        with self._inflight_lock:
+            socks = list(self._inflight)
+        for sock in socks:
+            self._cancelled.add(sock)
+            try:
+                # wakes up a blocking connect() or recv() in the worker
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+
+    def _get_mapping(self, server=None):
+        with trace_span(
+            "stun.request", server=addr_to_uri(server or self.stun_server_list[0])
+        ):
+            # ref: https://www.rfc-editor.org/rfc/rfc5389
+            socket_type = socket.SOCK_STREAM
+            stun_host, stun_port = server or self.stun_server_list[0]
+            sock = socket.socket(socket.AF_INET, socket_type)
+            with self._inflight_lock:
+                self._inflight.add(sock)
+            try:
+                try:
+                    socket_set_opt(
+                        sock,
+                        reuse=True,
+                        bind_addr=(self.source_host, self.source_port),
+                        timeout=3,
+                    )
+                except (OSError, socket.error) as ex:
+                    # not the server's fault, e.g. a listener without SO_REUSEPORT
+                    raise StunClient.SourcePortBusy(ex)
+                stun_ip = dns_cache.resolve(stun_host)
+                start_time = time.monotonic()
+                sock.connect((stun_ip, stun_port))
+                inner_addr = sock.getsockname()
+                self.source_host, self.source_port = inner_addr
+                sock.send(
+                    struct.pack(
+                        "!LLLLL",
+                        0x00010000,
+                        0x2112A442,
+                        0x4E415452,
+                        random.getrandbits(32),
+                        random.getrandbits(32),
+                    )
+                )
+                buff = sock.recv(1500)
+                ip = port = 0
+                payload = buff[20:]
+                while payload:
+                    attr_type, attr_len = struct.unpack("!HH", payload[:4])
+                    if attr_type in [1, 32]:
+                        _, _, port, ip = struct.unpack(
+                            "!BBHL", payload[4 : 4 + attr_len]
+                        )
+                        if attr_type == 32:
+                            port ^= 0x2112
+                            ip ^= 0x2112A442
+                        break
+                    payload = payload[4 + attr_len :]
+                else:
+                    raise ValueError("Invalid STUN response")
+                outer_addr = (
+                    socket.inet_ntop(socket.AF_INET, struct.pack("!L", ip)),
+                    port,
+                )
+                rtt = time.monotonic() - start_time
+                if self.scoreboard:
+                    self.scoreboard.record((stun_host, stun_port), True, rtt)
+                if metrics:
+                    metrics.stun_latency.observe(
+                        rtt, server=addr_to_uri((stun_host, stun_port))
+                    )
+                logging.debug(
+                    "stun: Got address %s from %s, source %s"
+                    % (
+                        addr_to_uri(outer_addr),
+                        addr_to_uri((stun_host, stun_port)),
+                        addr_to_uri(inner_addr),
+                    )
+                )
+                return inner_addr, outer_addr
+            except StunClient.SourcePortBusy:
+                raise
+            except (OSError, ValueError, struct.error, socket.error) as ex:
+                if sock not in self._cancelled:
+                    if self.scoreboard:
+                        self.scoreboard.record((stun_host, stun_port), False)
+                    if metrics:
+                        metrics.stun_failures.inc(
+                            server=addr_to_uri((stun_host, stun_port))
+                        )
+                raise StunClient.ServerUnavailable(ex)
+            finally:
+                with self._inflight_lock:
+                    self._inflight.discard(sock)
+                    self._cancelled.discard(sock)
+                sock.close()
+
+
+class MappingMonitor(object):
+    def __init__(self, stun, outer_addr, interval=5, on_change=None):
+        self.stun = stun
+        self.outer_addr = outer_addr
+        self.interval = interval
+        self.on_change = on_change
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="mapping-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(self.interval)
+
+    def _run(self):
+        servers = self.stun.stun_server_list
+        while not self._stop_event.wait(self.interval):
+            try:
+                outer_addr = self._probe(servers[0])
+            except StunClient.SourcePortBusy as ex:
+                # expected in direct mode: the service took the port without
+                # SO_REUSEPORT, re-probing needs a listener that shares it,
+                # e.g. ForwardRelay
+                logging.debug(
+                    "stun: Cannot re-probe from port %d: %s, "
+                    "mapping drift detection is disabled" % (self.stun.source_port, ex)
+                )
+                return
+            except StunClient.ServerUnavailable as ex:
+                logging.debug(
+                    "stun: STUN server %s is unavailable: %s"
+                    % (addr_to_uri(servers[0]), ex)
+                )
+                servers.append(servers.pop(0))
+                continue
+            if outer_addr == self.outer_addr:
+                continue
+            # ask another server, a single answer may come from a bad server
+            servers.append(servers.pop(0))
+            try:
+                confirmed = self._probe(servers[0]) == outer_addr
+            except StunClient.ServerUnavailable:
+                confirmed = True
+            if not confirmed:
+                continue
+            logging.warning(
+                "stun: Mapping changed from %s to %s"
+                % (addr_to_uri(self.outer_addr), addr_to_uri(outer_addr))
             )
-            buff = sock.recv(1500)
-            ip = port = 0
-            payload = buff[20:]
-            while payload:
-                attr_type, attr_len = struct.unpack("!HH", payload[:4])
-                if attr_type in [1, 32]:
-                    _, _, port, ip = struct.unpack("!BBHL", payload[4 : 4 + attr_len])
-                    if attr_type == 32:
+            self.outer_addr = outer_addr
+            if self.on_change:
+                self.on_change(outer_addr)
+
+    def _probe(self, server):
+        _, outer_addr = self.stun._get_mapping(server)
+        return outer_addr
+
+
+class MappingLifetimeCalibrator(object):
+    # Binary-searches how long the NAT keeps the mapping of an idle TCP
+    # connection. Each trial opens a keep-alive connection from a fresh
+    # source port, leaves it idle, then asks STUN again from that port: a
+    # different outer address, or a dead connection, means it expired.
+    def __init__(
+        self,
+        stun_server_list,
+        keepalive_host,
+        keepalive_port,
+        low=15,
+        high=900,
+        resolution=15,
+    ):
+        self.stun_server_list = stun_server_list
+        self.keepalive_host = keepalive_host
+        self.keepalive_port = keepalive_port
+        self.low = low
+        self.high = high
+        self.resolution = resolution
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def measure(self):
+        # `low` is assumed to be safe, it is what keep-alive used so far
+        low, high = self.low, self.high
+        while high - low > self.resolution:
+            idle = (low + high) // 2
+            with trace_span("calibrate.trial", idle=idle):
+                survived = self._trial(idle)
+            if survived is None:
+                return None
+            logging.info(
+                "calibrate: Idle mapping %s %ds"
+                % ("survived" if survived else "expired within", idle)
+            )
+            if survived:
+                low = idle
+            else:
+                high = idle
+        return low
+
+    def _trial(self, idle):
+        stun = StunClient(list(self.stun_server_list))
+        # unlike get_mapping(), gives up when every server is down
+        outer_addr = self._probe(stun)
+        if outer_addr is None:
+            return None
+        keepalive = KeepAliveSession(
+            self.keepalive_host,
+            self.keepalive_port,
+            stun.source_host,
+            stun.source_port,
+            interval=idle,
+        )
+        try:
+            sock = keepalive._connect()
+        except (OSError, socket.error, ValueError) as ex:
+            logging.debug("calibrate: Cannot hold the mapping: %s" % ex)
+            return None
+        try:
+            # a TCP keep-alive probe at the idle boundary would refresh the
+            # mapping right before it is checked
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 0)
+            if self._stop_event.wait(idle):
+                return None
+            outer_addr_after = self._probe(stun)
+            if outer_addr_after is None:
+                return None
+            if outer_addr_after != outer_addr:
+                return False
+            # the server may have dropped the idle connection as well
+            try:
+                keepalive._request(sock)
+            except (OSError, socket.error, ValueError):
+                return False
+            return True
+        finally:
+            sock.close()
+
+    def _probe(self, stun):
+        for server in stun.stun_server_list:
+            if self._stop_event.is_set():
+                return None
+            try:
+                _, outer_addr = stun._get_mapping(server)
+                return outer_addr
+            except StunClient.ServerUnavailable:
+                continue
+        return None
+
+
+class NatBehavior(object):
+    ENDPOINT_INDEPENDENT = "endpoint-independent"
+    ADDRESS_DEPENDENT = "address-dependent"
+    ADDRESS_AND_PORT_DEPENDENT = "address-and-port-dependent"
+    NO_NAT = "no-nat"
+    UNKNOWN = "unknown"
+
+    def __init__(self, mapping, filtering, mapped_addr=None, server=None):
+        self.mapping = mapping
+        self.filtering = filtering
+        self.mapped_addr = mapped_addr
+        self.server = server
+
+    def __repr__(self):
+        return "<NatBehavior mapping=%s, filtering=%s>" % (
+            repr(self.mapping),
+            repr(self.filtering),
+        )
+
+    def is_known(self):
+        return NatBehavior.UNKNOWN not in (self.mapping, self.filtering)
+
+    def is_punchable(self):
+        # True/False when the result is conclusive, None when it needs a probe
+        if self.mapping in (
+            NatBehavior.ADDRESS_DEPENDENT,
+            NatBehavior.ADDRESS_AND_PORT_DEPENDENT,
+        ):
+            return False
+        if (
+            self.mapping
+            in (
+                NatBehavior.ENDPOINT_INDEPENDENT,
+                NatBehavior.NO_NAT,
+            )
+            and self.filtering == NatBehavior.ENDPOINT_INDEPENDENT
+        ):
+            return True
+        # the router may still forward our TCP port via UPnP or DMZ
+        return None
+
+
+class NatBehaviorTest(object):
+    # ref: https://www.rfc-editor.org/rfc/rfc5780
+    ATTR_MAPPED_ADDRESS = 0x0001
+    ATTR_CHANGE_REQUEST = 0x0003
+    ATTR_CHANGED_ADDRESS = 0x0005
+    ATTR_XOR_MAPPED_ADDRESS = 0x0020
+    ATTR_OTHER_ADDRESS = 0x802C
+
+    _cache = {}  # (local_ip, outer_ip) => (NatBehavior, expiry or None)
+    _cache_lock = threading.Lock()
+    # UDP 3478 is often blocked, don't pay the timeouts on every punch
+    UNKNOWN_TTL = 300
+
+    def __init__(self, stun_server_list, timeout=1.5, max_servers=4):
+        self.stun_server_list = stun_server_list
+        self.timeout = timeout
+        self.max_servers = max_servers
+
+    @classmethod
+    def invalidate(cls):
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    def get_behavior(self, local_ip, outer_ip):
+        key = (local_ip, outer_ip)
+        with NatBehaviorTest._cache_lock:
+            behavior, expiry = NatBehaviorTest._cache.get(key, (None, None))
+        if behavior and (expiry is None or expiry > time.monotonic()):
+            return behavior
+        behavior = self.classify()
+        expiry = None
+        if not behavior.is_known():
+            expiry = time.monotonic() + NatBehaviorTest.UNKNOWN_TTL
+        with NatBehaviorTest._cache_lock:
+            NatBehaviorTest._cache[key] = (behavior, expiry)
+        return behavior
+
+    def classify(self):
+        with trace_span("nat.behavior_test"):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            socket_set_opt(sock, bind_addr=("0.0.0.0", 0))
+            try:
+                for stun_host, stun_port in self.stun_server_list[: self.max_servers]:
+                    try:
+                        server = (dns_cache.resolve(stun_host), stun_port)
+                        attrs = self._request(sock, server)
+                    except (OSError, socket.error, ValueError, struct.error) as ex:
+                        logging.debug(
+                            "nat-test: STUN server %s is unavailable: %s"
+                            % (addr_to_str((stun_host, stun_port)), ex)
+                        )
+                        continue
+                    if attrs is None:
+                        continue
+                    mapped = attrs.get("mapped")
+                    other = attrs.get("other")
+                    if not mapped or not other:
+                        logging.debug(
+                            "nat-test: STUN server %s does not support RFC 5780"
+                            % addr_to_str((stun_host, stun_port))
+                        )
+                        continue
+                    try:
+                        local_addr = (get_local_ip(server), sock.getsockname()[1])
+                        mapping = self._test_mapping(
+                            sock, server, other, mapped, local_addr
+                        )
+                        filtering = self._test_filtering(server)
+                    except (OSError, socket.error, ValueError, struct.error) as ex:
+                        # e.g. an unroutable OTHER-ADDRESS
+                        logging.debug(
+                            "nat-test: test via %s failed: %s"
+                            % (addr_to_str(server), ex)
+                        )
+                        break
+                    behavior = NatBehavior(mapping, filtering, mapped, server)
+                    logging.debug(
+                        "nat-test: %s by %s" % (behavior, addr_to_str(server))
+                    )
+                    return behavior
+            finally:
+                sock.close()
+            return NatBehavior(NatBehavior.UNKNOWN, NatBehavior.UNKNOWN)
+
+    def _test_mapping(self, sock, server, other, mapped1, local_addr):
+        if mapped1 == local_addr:
+            return NatBehavior.NO_NAT
+        attrs2 = self._request(sock, (other[0], server[1]))
+        if attrs2 is None or not attrs2.get("mapped"):
+            return NatBehavior.UNKNOWN
+        if attrs2["mapped"] == mapped1:
+            return NatBehavior.ENDPOINT_INDEPENDENT
+        attrs3 = self._request(sock, other)
+        if attrs3 is None or not attrs3.get("mapped"):
+            return NatBehavior.UNKNOWN
+        if attrs3["mapped"] == attrs2["mapped"]:
+            return NatBehavior.ADDRESS_DEPENDENT
+        return NatBehavior.ADDRESS_AND_PORT_DEPENDENT
+
+    def _test_filtering(self, server):
+        # use a fresh socket: the mapping tests have already opened the filter
+        # for the alternate address on the first one
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        socket_set_opt(sock, bind_addr=("0.0.0.0", 0))
+        try:
+            if not self._request(sock, server):
+                return NatBehavior.UNKNOWN
+            if self._request(sock, server, change_ip=True, change_port=True):
+                return NatBehavior.ENDPOINT_INDEPENDENT
+            if self._request(sock, server, change_port=True):
+                return NatBehavior.ADDRESS_DEPENDENT
+            return NatBehavior.ADDRESS_AND_PORT_DEPENDENT
+        finally:
+            sock.close()
+
+    def _request(self, sock, server, change_ip=False, change_port=False):
+        tid = struct.pack(
+            "!LLL", 0x4E415452, random.getrandbits(32), random.getrandbits(32)
+        )
+        attrs = b""
+        if change_ip or change_port:
+            flags = (4 if change_ip else 0) | (2 if change_port else 0)
+            attrs = struct.pack("!HHL", NatBehaviorTest.ATTR_CHANGE_REQUEST, 4, flags)
+        data = struct.pack("!HHL", 0x0001, len(attrs), 0x2112A442) + tid + attrs
+        deadline = time.monotonic() + self.timeout
+        # retransmit once if the first packet gets no early answer
+        resend_at = time.monotonic() + self.timeout / 3
+        sock.sendto(data, server)
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return None
+            if resend_at and now >= resend_at:
+                sock.sendto(data, server)
+                resend_at = None
+            sock.settimeout(min(deadline, resend_at or deadline) - now)
+            try:
+                buff, _ = sock.recvfrom(1500)
+            except socket.timeout:
+                continue
+            if len(buff) < 20 or buff[8:20] != tid:
+                continue
+            return self._parse(buff)
+
+    def _parse(self, buff):
+        msg_type, msg_len = struct.unpack("!HH", buff[:4])
+        if msg_type != 0x0101:
+            raise ValueError("Invalid STUN response")
+        attrs = {}
+        payload = buff[20 : 20 + msg_len]
+        while len(payload) >= 4:
+            attr_type, attr_len = struct.unpack("!HH", payload[:4])
+            value = payload[4 : 4 + attr_len]
+            if attr_type in (
+                NatBehaviorTest.ATTR_MAPPED_ADDRESS,
+                NatBehaviorTest.ATTR_XOR_MAPPED_ADDRESS,
+                NatBehaviorTest.ATTR_OTHER_ADDRESS,
+                NatBehaviorTest.ATTR_CHANGED_ADDRESS,
+            ):
+                _, family, port, ip = struct.unpack("!BBHL", value[:8])
+                if family == 1:
+                    if attr_type == NatBehaviorTest.ATTR_XOR_MAPPED_ADDRESS:
                         port ^= 0x2112
                         ip ^= 0x2112A442
-                    break
-                payload = payload[4 + attr_len :]
-            else:
-                raise ValueError("Invalid STUN response")
-            outer_addr = socket.inet_ntop(socket.AF_INET, struct.pack("!L", ip)), port
-            logging.debug(
-                "stun: Got address %s from %s, source %s"
-                % (
-                    addr_to_uri(outer_addr),
-                    addr_to_uri((stun_host, stun_port)),
-                    addr_to_uri(inner_addr),
+                    addr = socket.inet_ntop(socket.AF_INET, struct.pack("!L", ip)), port
+                    if attr_type == NatBehaviorTest.ATTR_XOR_MAPPED_ADDRESS:
+                        attrs["mapped"] = addr
+                    elif attr_type == NatBehaviorTest.ATTR_MAPPED_ADDRESS:
+                        attrs.setdefault("mapped", addr)
+                    elif attr_type == NatBehaviorTest.ATTR_OTHER_ADDRESS:
+                        attrs["other"] = addr
+                    else:
+                        attrs.setdefault("other", addr)
+            # attributes are padded to a multiple of 4 bytes
+            payload = payload[4 + (attr_len + 3) // 4 * 4 :]
+        return attrs
+
+
+class KeepAliveSession(object):
+    class SourcePortBusy(OSError):
+        pass
+
+    def __init__(
+        self, host, port, source_host, source_port, interval=15, on_status=None
+    ):
+        self.host = host
+        self.port = port
+        self.source_host = source_host
+        self.source_port = source_port
+        self.interval = interval
+        self.on_status = on_status
+        self.alive = False
+        self._sock = None
+        self._sock_timeout = 3
+        self._max_backoff = 60
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="keep-alive", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        sock = self._sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(self._sock_timeout)
+
+    def _run(self):
+        backoff = 1
+        while not self._stop_event.is_set():
+            try:
+                self._sock = self._connect()
+                self._set_status(True)
+                backoff = 1
+                self._serve(self._sock)
+            except KeepAliveSession.SourcePortBusy as ex:
+                # the service took the port without SO_REUSEPORT (direct mode),
+                # retrying cannot succeed until it is restarted
+                logging.error(
+                    "keep-alive: Cannot reconnect from port %d: %s, "
+                    "the mapping is now held only by incoming traffic"
+                    % (self.source_port, ex)
                 )
+                self._set_status(False)
+                break
+            except (OSError, socket.error, ValueError) as ex:
+                if not self._stop_event.is_set():
+                    logging.warning("keep-alive: Connection lost: %s" % ex)
+            finally:
+                if self._sock:
+                    self._sock.close()
+                    self._sock = None
+            if self._stop_event.is_set():
+                break
+            self._set_status(False)
+            self._stop_event.wait(backoff)
+            backoff = min(backoff * 2, self._max_backoff)
+
+    def _set_status(self, alive):
+        if alive == self.alive:
+            return
+        self.alive = alive
+        if self.on_status:
+            self.on_status(alive)
+
+    def _connect(self):
+        with trace_span(
+            "keepalive.connect", server=addr_to_uri((self.host, self.port))
+        ):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                try:
+                    socket_set_opt(
+                        sock,
+                        reuse=True,
+                        bind_addr=(self.source_host, self.source_port),
+                        timeout=self._sock_timeout,
+                    )
+                except (OSError, socket.error) as ex:
+                    raise KeepAliveSession.SourcePortBusy(*ex.args)
+                socket_set_keepalive(sock, idle=self.interval)
+                sock.connect((dns_cache.resolve(self.host), self.port))
+                logging.debug(
+                    "keep-alive: Connected to host %s"
+                    % (addr_to_uri((self.host, self.port)))
+                )
+                self._request(sock)
+            except:
+                sock.close()
+                raise
+            return sock
+
+    def _serve(self, sock):
+        while not self._stop_event.is_set():
+            # an idle connection becomes readable only when it is closed
+            readable, _, _ = select.select([sock], [], [], self.interval)
+            if self._stop_event.is_set():
+                return
+            if readable:
+                if not sock.recv(4096):
+                    raise OSError("Keep-alive server closed connection")
+                continue
+            self._request(sock)
+
+    def _request(self, sock):
+        sock.sendall(
+            (
+                "HEAD /natter-keep-alive HTTP/1.1\r\n"
+                "Host: %s\r\n"
+                "User-Agent: curl/8.0.0 (Natter)\r\n"
+                "Accept: */*\r\n"
+                "Connection: keep-alive\r\n"
+                "\r\n" % self.host
+            ).encode()
+        )
+        buff = b""
+        # a response to HEAD carries no body, the headers are all we need
+        while b"\r\n\r\n" not in buff:
+            data = sock.recv(4096)
+            if not data:
+                raise OSError("Keep-alive server closed connection")
+            buff += data
+            if len(buff) > 65536:
+                raise ValueError("Response header is too large")
+        if not buff.startswith(b"HTTP/"):
+            raise ValueError("Invalid response from keep-alive server")
+        logging.debug("keep-alive: OK")
+
+
+class ForwardRelay(object):
+    def __init__(self, listen_port, dest_host, dest_port, listen_host="0.0.0.0"):
+        self.listen_addr = (listen_host, listen_port)
+        self.dest_addr = (dest_host, dest_port)
+        # splice(2) moves data between sockets without copying it to user space
+        self.zero_copy = hasattr(os, "splice")
+        self._buff_size = 65536
+        self._pipe_size = 1048576
+        self._sock = None
+        self._sock_timeout = 1
+        self._conns = set()
+        self._lock = threading.Lock()
+        self._closing = False
+        self._thread = None
+
+    def __repr__(self):
+        return "<ForwardRelay %s => %s>" % (
+            addr_to_str(self.listen_addr),
+            addr_to_str(self.dest_addr),
+        )
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # SO_REUSEPORT lets STUN and keep-alive share the listening port
+        socket_set_opt(
+            sock,
+            reuse=True,
+            bind_addr=self.listen_addr,
+            timeout=self._sock_timeout,
+        )
+        sock.listen(128)
+        self._sock = sock
+        self._closing = False
+        self._thread = threading.Thread(
+            target=self._accept_loop, name="relay-accept", daemon=True
+        )
+        self._thread.start()
+        logging.debug("relay: Forwarding %s" % self)
+
+    def close(self, drain=True):
+        # with drain, established connections are left to finish on their own.
+        # Never blocks: shutdown() wakes the accept() on Linux, elsewhere the
+        # accept loop notices within _sock_timeout
+        self._closing = True
+        if self._sock:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+        if drain:
+            return
+        with self._lock:
+            conns = list(self._conns)
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+
+    def connection_count(self):
+        with self._lock:
+            return len(self._conns) // 2
+
+    def _accept_loop(self):
+        try:
+            while not self._closing:
+                try:
+                    client, _ = self._sock.accept()
+                except socket.timeout:
+                    continue
+                except (OSError, socket.error) as ex:
+                    if self._closing:
+                        break
+                    logging.error("relay: Failed to accept connection: %s" % ex)
+                    time.sleep(self._sock_timeout)
+                    continue
+                threading.Thread(
+                    target=self._handle, args=(client,), name="relay", daemon=True
+                ).start()
+        finally:
+            self._sock.close()
+
+    def _handle(self, client):
+        try:
+            upstream = socket.create_connection(self.dest_addr, timeout=3)
+        except (OSError, socket.error) as ex:
+            logging.error(
+                "relay: Failed to connect to %s: %s" % (addr_to_str(self.dest_addr), ex)
             )
-            return inner_addr, outer_addr
-        except (OSError, ValueError, struct.error, socket.error) as ex:
-            raise StunClient.ServerUnavailable(ex)
+            client.close()
+            return
+        upstream.settimeout(None)
+        client.settimeout(None)
+        for sock in (client, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._lock:
+            self._conns.update((client, upstream))
+        try:
+            t = threading.Thread(
+                target=self._pump, args=(upstream, client), name="relay", daemon=True
+            )
+            t.start()
+            self._pump(client, upstream)
+            t.join()
         finally:
-            sock.close()
+            with self._lock:
+                self._conns.difference_update((client, upstream))
+            client.close()
+            upstream.close()
 
+    def _pump(self, src, dst):
+        try:
+            if self.zero_copy:
+                self._pump_splice(src, dst)
+            else:
+                self._pump_copy(src, dst)
+        except (OSError, socket.error):
+            # a reset on one side tears down both directions
+            for sock in (src, dst):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except (OSError, socket.error):
+                    pass
+            return
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except (OSError, socket.error):
+            pass
 
-def keep_alive(host, port, source_host, source_port):
-    sock_type = socket.SOCK_STREAM
-    sock = socket.socket(socket.AF_INET, sock_type)
-    socket_set_opt(
-        sock,
-        reuse=True,
-        bind_addr=(source_host, source_port),
-        timeout=3,
-    )
-    sock.connect((host, port))
-    logging.debug("keep-alive: Connected to host %s" % (addr_to_uri((host, port))))
-    sock.sendall(
-        (
-            "HEAD /natter-keep-alive HTTP/1.1\r\n"
-            "Host: %s\r\n"
-            "User-Agent: curl/8.0.0 (Natter)\r\n"
-            "Accept: */*\r\n"
-            "Connection: keep-alive\r\n"
-            "\r\n" % host
-        ).encode()
-    )
-    buff = b""
-    try:
+    def _pump_splice(self, src, dst):
+        rfd, wfd = os.pipe()
+        try:
+            try:
+                fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, self._pipe_size)
+            except (AttributeError, OSError):
+                # keep the default pipe size (64 KiB)
+                pass
+            src_fd = src.fileno()
+            dst_fd = dst.fileno()
+            while True:
+                n = os.splice(src_fd, wfd, self._pipe_size, flags=os.SPLICE_F_MOVE)
+                if n == 0:
+                    return
+                while n > 0:
+                    n -= os.splice(rfd, dst_fd, n, flags=os.SPLICE_F_MOVE)
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def _pump_copy(self, src, dst):
+        buff = bytearray(self._buff_size)
+        view = memoryview(buff)
         while True:
-            buff = sock.recv(4096)
-            if not buff:
-                raise OSError("Keep-alive server closed connection")
-    except socket.timeout as ex:
-        if not buff:
-            raise ex
-    logging.debug("keep-alive: OK")
+            n = src.recv_into(buff)
+            if n == 0:
+                return
+            dst.sendall(view[:n])
+
+
+class NetlinkMonitor(object):
+    # Listens for rtnetlink link, IPv4 address and default route events
+    # (Linux only). Waiters are woken on every event, so a caller can retry
+    # at once instead of polling.
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTM_NEWLINK, RTM_DELLINK = 16, 17
+    RTM_NEWADDR, RTM_DELADDR = 20, 21
+    RTM_NEWROUTE, RTM_DELROUTE = 24, 25
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.generation = 0
+        self._cond = threading.Condition()
+        self._sock = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not hasattr(socket, "AF_NETLINK"):
+            return False
+        try:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE
+            )
+            sock.bind(
+                (0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV4_ROUTE)
+            )
+            sock.settimeout(1)
+        except (OSError, socket.error) as ex:
+            logging.debug("netlink: Cannot subscribe to rtnetlink: %s" % ex)
+            return False
+        self._sock = sock
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="netlink", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(2)
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def wait(self, timeout, since=None):
+        # True if an event arrived after generation `since` (default: now)
+        with self._cond:
+            if since is None:
+                since = self.generation
+            self._cond.wait_for(lambda: self.generation != since, timeout)
+            return self.generation != since
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                data = self._sock.recv(65536)
+            except socket.timeout:
+                continue
+            except (OSError, socket.error) as ex:
+                if self._stop_event.is_set():
+                    break
+                # ENOBUFS: events were dropped, treat it as a change
+                logging.debug("netlink: recv failed: %s" % ex)
+                self._notify({"overflow"})
+                continue
+            kinds = self._parse(data)
+            if kinds:
+                self._notify(kinds)
+
+    def _parse(self, data):
+        kinds = set()
+        offset = 0
+        while offset + 16 <= len(data):
+            length, msg_type = struct.unpack_from("=LH", data, offset)
+            if length < 16:
+                break
+            if msg_type in (self.RTM_NEWLINK, self.RTM_DELLINK):
+                kinds.add("link")
+            elif msg_type in (self.RTM_NEWADDR, self.RTM_DELADDR):
+                kinds.add("addr")
+            elif msg_type in (self.RTM_NEWROUTE, self.RTM_DELROUTE):
+                # struct rtmsg: family, dst_len, ...; only default routes matter
+                if length >= 28 and data[offset + 17] == 0:
+                    kinds.add("route")
+            offset += (length + 3) & ~3
+        return kinds
+
+    def _notify(self, kinds):
+        with self._cond:
+            self.generation += 1
+            self._cond.notify_all()
+        if self.on_event:
+            self.on_event(kinds)
+
+
+class StageTimer(object):
+    # Wall time of each startup stage. The sum is what running the stages
+    # one after another would have cost, compared against the elapsed time.
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def run(self, name, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def merge(self, other):
+        for name, seconds in other.stages.items():
+            self.add(name, seconds)
+
+    def serial(self):
+        return sum(self.stages.values())
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+
+class NatterMapping(object):
+    def __init__(
+        self, inner_addr, outer_addr, upnp, nat_behavior, keepalive, monitor, timer=None
+    ):
+        self.inner_ip, self.inner_port = inner_addr
+        self.outer_ip, self.outer_port = outer_addr
+        self.upnp = upnp
+        self.nat_behavior = nat_behavior
+        self.keepalive = keepalive
+        self.monitor = monitor
+        self.timer = timer
+
+    def __repr__(self):
+        return "<NatterMapping inner=%s, outer=%s>" % (
+            addr_to_str((self.inner_ip, self.inner_port)),
+            addr_to_str((self.outer_ip, self.outer_port)),
+        )
+
+    def close(self):
+        self.monitor.stop()
+        self.keepalive.stop()
+        self.upnp.clear()
+
+
+class XmlFieldParser(object):
+    # Collects the text of leaf elements by local name, namespaces dropped.
+    # With a `container` tag there is one record per container element,
+    # otherwise every leaf goes into `fields`; the first occurrence wins.
+    def __init__(self, container=None):
+        self.container = container
+        self.fields = {}
+        self.records = []
+        self._names = {}
+        self._parser = ElementTree.XMLPullParser(events=("end",))
+        self._fed = False
+        self._error = None
+
+    def feed(self, data):
+        # errors are held until close() so the HTTP body is still drained
+        if self._error:
+            return
+        self._fed = True
+        try:
+            self._parser.feed(data)
+            self._read_events()
+        except ElementTree.ParseError as ex:
+            self._error = ex
+
+    def close(self):
+        if self._fed and not self._error:
+            try:
+                self._parser.close()
+                self._read_events()
+            except ElementTree.ParseError as ex:
+                self._error = ex
+        if self._error:
+            raise ValueError("Invalid XML: %s" % self._error)
+        return self
+
+    def _local_name(self, tag):
+        name = self._names.get(tag)
+        if name is None:
+            name = self._names[tag] = tag.rsplit("}", 1)[-1]
+        return name
+
+    def _read_events(self):
+        for _, elem in self._parser.read_events():
+            if self.container is None:
+                if len(elem) == 0:
+                    self.fields.setdefault(
+                        self._local_name(elem.tag), (elem.text or "").strip()
+                    )
+            elif self._local_name(elem.tag) == self.container:
+                record = {}
+                for child in elem:
+                    if len(child) == 0:
+                        record.setdefault(
+                            self._local_name(child.tag), (child.text or "").strip()
+                        )
+                self.records.append(record)
+                elem.clear()
 
 
 class UPnPService(object):
+    class SoapError(Exception):
+        def __init__(self, errno, errmsg):
+            super().__init__("[%s] %s" % (errno, errmsg))
+            self.errno = errno
+            self.errmsg = errmsg
+
     def __init__(self, device):
         self.device = device
         self.service_type = None
@@ -159,6 +1315,8 @@ class UPnPService(object):
         self.control_url = None
         self.eventsub_url = None
         self._sock_timeout = 3
+        self._conn = None
+        self._conn_lock = threading.Lock()
 
     def __repr__(self):
         return "<UPnPService service_type=%s, service_id=%s>" % (
@@ -186,92 +1344,160 @@ class UPnPService(object):
         return False
 
     def forward_port(self, host, port, dest_host, dest_port, duration=0):
+        try:
+            self.add_port_mapping(host, port, dest_host, dest_port, duration)
+        except UPnPService.SoapError as ex:
+            logging.error(
+                "upnp: Error from service %s of device %s: %s"
+                % (self.service_type, self.device, ex)
+            )
+            return False
+        return True
+
+    def add_port_mapping(self, host, port, dest_host, dest_port, duration=0):
         if not self.is_forward():
             raise NotImplementedError(
                 "Unsupported service type: %s" % self.service_type
             )
 
         proto = "TCP"
-        ctl_hostname, ctl_port, ctl_path = split_url(self.control_url)
         descpt = "Natter"
-        content = (
-            '<?xml version="1.0" encoding="utf-8"?>\r\n'
-            '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"\r\n'
-            '  s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">\r\n'
-            "  <s:Body>\r\n"
-            '    <m:AddPortMapping xmlns:m="%s">\r\n'
-            "      <NewRemoteHost>%s</NewRemoteHost>\r\n"
-            "      <NewExternalPort>%s</NewExternalPort>\r\n"
-            "      <NewProtocol>%s</NewProtocol>\r\n"
-            "      <NewInternalPort>%s</NewInternalPort>\r\n"
-            "      <NewInternalClient>%s</NewInternalClient>\r\n"
-            "      <NewEnabled>1</NewEnabled>\r\n"
-            "      <NewPortMappingDescription>%s</NewPortMappingDescription>\r\n"
-            "      <NewLeaseDuration>%d</NewLeaseDuration>\r\n"
-            "    </m:AddPortMapping>\r\n"
-            "  </s:Body>\r\n"
-            "</s:Envelope>\r\n"
-            % (
-                self.service_type,
-                host,
-                port,
-                proto,
-                dest_port,
-                dest_host,
-                descpt,
-                duration,
-            )
+        self._soap_call(
+            "AddPortMapping",
+            [
+                ("NewRemoteHost", host),
+                ("NewExternalPort", port),
+                ("NewProtocol", proto),
+                ("NewInternalPort", dest_port),
+                ("NewInternalClient", dest_host),
+                ("NewEnabled", 1),
+                ("NewPortMappingDescription", descpt),
+                ("NewLeaseDuration", duration),
+            ],
         )
-        content_len = len(content.encode())
-        data = (
-            "POST %s HTTP/1.1\r\n"
-            "Host: %s:%d\r\n"
-            "User-Agent: curl/8.0.0 (Natter)\r\n"
-            "Accept: */*\r\n"
-            'SOAPAction: "%s#AddPortMapping"\r\n'
-            "Content-Type: text/xml\r\n"
-            "Content-Length: %d\r\n"
-            "Connection: close\r\n"
-            "\r\n"
-            "%s\r\n"
-            % (
-                ctl_path,
-                ctl_hostname,
-                ctl_port,
-                self.service_type,
-                content_len,
-                content,
+
+    def get_port_mapping(self, host, port):
+        r = self._soap_call(
+            "GetSpecificPortMappingEntry",
+            [
+                ("NewRemoteHost", host),
+                ("NewExternalPort", port),
+                ("NewProtocol", "TCP"),
+            ],
+        )
+        entry = {}
+        for name in ("NewInternalPort", "NewInternalClient", "NewLeaseDuration"):
+            entry[name] = r.get(name)
+        return entry
+
+    def delete_port_mapping(self, host, port):
+        self._soap_call(
+            "DeletePortMapping",
+            [
+                ("NewRemoteHost", host),
+                ("NewExternalPort", port),
+                ("NewProtocol", "TCP"),
+            ],
+        )
+
+    def get_external_ip(self):
+        r = self._soap_call("GetExternalIPAddress", [])
+        if not r.get("NewExternalIPAddress"):
+            raise ValueError("Invalid response from service %s" % self.service_type)
+        return r["NewExternalIPAddress"]
+
+    def close(self):
+        with self._conn_lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def _soap_call(self, action, args):
+        with trace_span("upnp.soap", action=action):
+            ctl_hostname, ctl_port, ctl_path = split_url(self.control_url)
+            content = (
+                '<?xml version="1.0" encoding="utf-8"?>\r\n'
+                '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"\r\n'
+                '  s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">\r\n'
+                "  <s:Body>\r\n"
+                '    <m:%s xmlns:m="%s">\r\n'
+                "%s"
+                "    </m:%s>\r\n"
+                "  </s:Body>\r\n"
+                "</s:Envelope>\r\n"
+                % (
+                    action,
+                    self.service_type,
+                    "".join("      <%s>%s</%s>\r\n" % (k, v, k) for k, v in args),
+                    action,
+                )
             )
-        ).encode()
+            content_len = len(content.encode())
+            data = (
+                "POST %s HTTP/1.1\r\n"
+                "Host: %s:%d\r\n"
+                "User-Agent: curl/8.0.0 (Natter)\r\n"
+                "Accept: */*\r\n"
+                'SOAPAction: "%s#%s"\r\n'
+                "Content-Type: text/xml\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: keep-alive\r\n"
+                "\r\n"
+                "%s"
+                % (
+                    ctl_path,
+                    ctl_hostname,
+                    ctl_port,
+                    self.service_type,
+                    action,
+                    content_len,
+                    content,
+                )
+            ).encode()
+            with self._conn_lock:
+                status, xml = self._exchange((ctl_hostname, ctl_port), data)
+            r = xml.close().fields
+            errno = r.get("errorCode", "")
+            errmsg = r.get("errorDescription", "")
+            if errno or errmsg:
+                raise UPnPService.SoapError(errno, errmsg)
+            if status != 200:
+                raise ValueError(
+                    "HTTP %d from service %s" % (status, self.service_type)
+                )
+            return r
+
+    def _exchange(self, addr, data):
+        # reuse the control connection while the router keeps it open
+        if self._conn:
+            try:
+                self._conn.sendall(data)
+                return self._read_response(self._conn)
+            except (OSError, socket.error, ValueError):
+                self._conn.close()
+                self._conn = None
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         socket_set_opt(
             sock,
             timeout=self._sock_timeout,
         )
-        sock.connect((ctl_hostname, ctl_port))
-        sock.sendall(data)
-        response = b""
-        while True:
-            buff = sock.recv(4096)
-            if not buff:
-                break
-            response += buff
-        sock.close()
-        r = response.decode("utf-8", "ignore")
-        errno = errmsg = ""
-        m = re.search(r"<errorCode\s*>([^<]*?)</errorCode\s*>", r)
-        if m:
-            errno = m.group(1).strip()
-        m = re.search(r"<errorDescription\s*>([^<]*?)</errorDescription\s*>", r)
-        if m:
-            errmsg = m.group(1).strip()
-        if errno or errmsg:
-            logging.error(
-                "upnp: Error from service %s of device %s: [%s] %s"
-                % (self.service_type, self.device, errno, errmsg)
-            )
-            return False
-        return True
+        try:
+            sock.connect(addr)
+            sock.sendall(data)
+            self._conn = sock
+            return self._read_response(sock)
+        except:
+            sock.close()
+            self._conn = None
+            raise
+
+    def _read_response(self, sock):
+        xml = XmlFieldParser()
+        status, _, _, keep = http_read_response(sock, sink=xml.feed)
+        if not keep:
+            sock.close()
+            self._conn = None
+        return status, xml
 
 
 class UPnPDevice(object):
@@ -291,102 +1517,172 @@ class UPnPDevice(object):
         services_d = {}  # service_id => UPnPService()
         for url in self.xml_urls:
             sd = self._get_srv_dict(url)
-            services_d.update(sd)
+            if sd:
+                services_d.update(sd)
         self.services.extend(services_d.values())
         for srv in self.services:
             if srv.is_forward():
                 self.forward_srv = srv
                 break
 
-    def _http_get(self, url):
-        hostname, port, path = split_url(url)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        socket_set_opt(
-            sock,
-            timeout=self._sock_timeout,
-        )
-        sock.connect((hostname, port))
-        data = (
-            "GET %s HTTP/1.1\r\n"
-            "Host: %s\r\n"
-            "User-Agent: curl/8.0.0 (Natter)\r\n"
-            "Accept: */*\r\n"
-            "Connection: close\r\n"
-            "\r\n" % (path, hostname)
-        ).encode()
-        sock.sendall(data)
-        response = b""
-        while True:
-            buff = sock.recv(4096)
-            if not buff:
-                break
-            response += buff
-        sock.close()
-        if not response.startswith(b"HTTP/"):
-            raise ValueError("Invalid response from HTTP server")
-        s = response.split(b"\r\n\r\n", 1)
-        if len(s) != 2:
-            raise ValueError("Invalid response from HTTP server")
-        return s[1]
+    def _http_get(self, url, sink=None):
+        with trace_span("upnp.http_get", url=url):
+            hostname, port, path = split_url(url)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            socket_set_opt(
+                sock,
+                timeout=self._sock_timeout,
+            )
+            sock.connect((hostname, port))
+            data = (
+                "GET %s HTTP/1.1\r\n"
+                "Host: %s\r\n"
+                "User-Agent: curl/8.0.0 (Natter)\r\n"
+                "Accept: */*\r\n"
+                "Connection: close\r\n"
+                "\r\n" % (path, hostname)
+            ).encode()
+            try:
+                sock.sendall(data)
+                status, _, body, _ = http_read_response(sock, sink=sink)
+            finally:
+                sock.close()
+            if status != 200:
+                raise ValueError("HTTP %d from %s" % (status, url))
+            return body
 
     def _get_srv_dict(self, url):
+        xml = XmlFieldParser("service")
         try:
-            xmlcontent = self._http_get(url).decode("utf-8", "ignore")
+            self._http_get(url, sink=xml.feed)
+            xml.close()
         except (OSError, socket.error, ValueError) as ex:
             logging.error("upnp: failed to load service from %s: %s" % (url, ex))
-            return
+            # services parsed before a malformed tail are still usable
+            if not xml.records:
+                return
         services_d = {}
-        srv_str_l = re.findall(r"<service\s*>([\s\S]+?)</service\s*>", xmlcontent)
-        for srv_str in srv_str_l:
+        for record in xml.records:
             srv = UPnPService(self)
-            m = re.search(r"<serviceType\s*>([^<]*?)</serviceType\s*>", srv_str)
-            if m:
-                srv.service_type = m.group(1).strip()
-            m = re.search(r"<serviceId\s*>([^<]*?)</serviceId\s*>", srv_str)
-            if m:
-                srv.service_id = m.group(1).strip()
-            m = re.search(r"<SCPDURL\s*>([^<]*?)</SCPDURL\s*>", srv_str)
-            if m:
-                srv.scpd_url = full_url(m.group(1).strip(), url)
-            m = re.search(r"<controlURL\s*>([^<]*?)</controlURL\s*>", srv_str)
-            if m:
-                srv.control_url = full_url(m.group(1).strip(), url)
-            m = re.search(r"<eventSubURL\s*>([^<]*?)</eventSubURL\s*>", srv_str)
-            if m:
-                srv.eventsub_url = full_url(m.group(1).strip(), url)
+            srv.service_type = record.get("serviceType") or None
+            srv.service_id = record.get("serviceId") or None
+            if record.get("SCPDURL"):
+                srv.scpd_url = full_url(record["SCPDURL"], url)
+            if record.get("controlURL"):
+                srv.control_url = full_url(record["controlURL"], url)
+            if record.get("eventSubURL"):
+                srv.eventsub_url = full_url(record["eventSubURL"], url)
             if srv.is_valid():
                 services_d[srv.service_id] = srv
         return services_d
 
 
 class UPnPClient(object):
-    def __init__(self):
+    # search targets answered by Internet Gateway Devices only
+    IGD_SEARCH_TARGETS = (
+        "urn:schemas-upnp-org:device:InternetGatewayDevice:1",
+        "urn:schemas-upnp-org:device:InternetGatewayDevice:2",
+        "urn:schemas-upnp-org:service:WANIPConnection:1",
+        "urn:schemas-upnp-org:service:WANIPConnection:2",
+        "urn:schemas-upnp-org:service:WANPPPConnection:1",
+        # some routers answer nothing but this one
+        "upnp:rootdevice",
+    )
+
+    def __init__(self, cache_path=None, lease=3600):
         self.ssdp_addr = ("239.255.255.250", 1900)
         self.router = None
+        self.cache_path = cache_path
+        self.lease = lease
         self._sock_timeout = 1
+        self._fetch_workers = 8
+        self._retry_interval = 30
         self._fwd_host = None
         self._fwd_port = None
         self._fwd_dest_host = None
         self._fwd_dest_port = None
         self._fwd_started = False
+        self._renew_stop = threading.Event()
+        self._renew_thread = None
+
+    def discover_router(self, fast=False, timeout=3):
+        with trace_span("upnp.discover_router", fast=fast):
+            if self.cache_path:
+                self.router = self._load_cached_router()
+                if self.router:
+                    return self.router
+            if fast:
+                try:
+                    self.router = self._discover_fast(time.monotonic() + timeout)
+                except (OSError, socket.error) as ex:
+                    logging.error("upnp: failed to discover router: %s" % ex)
+                    self.router = None
+                self._save_cached_router()
+                return self.router
+            router_l = []
+            try:
+                devs = self._discover()
+                for dev in devs:
+                    if dev.forward_srv:
+                        router_l.append(dev)
+            except (OSError, socket.error) as ex:
+                logging.error("upnp: failed to discover router: %s" % ex)
+            if not router_l:
+                self.router = None
+            elif len(router_l) > 1:
+                logging.warning("upnp: multiple routers found: %s" % (router_l,))
+                self.router = router_l[0]
+            else:
+                self.router = router_l[0]
+            self._save_cached_router()
+            return self.router
+
+    def _load_cached_router(self):
+        cache = load_json(self.cache_path)
+        if not cache:
+            return None
+        try:
+            dev = UPnPDevice(cache["ipaddr"], set(cache["xml_urls"]))
+            srv = UPnPService(dev)
+            srv.service_type = cache["service_type"]
+            srv.service_id = cache["service_id"]
+            srv.control_url = cache["control_url"]
+        except (KeyError, TypeError):
+            return None
+        if not srv.is_forward():
+            return None
+        dev.services.append(srv)
+        dev.forward_srv = srv
+        # one SOAP round-trip tells whether the router is still there
+        try:
+            external_ip = srv.get_external_ip()
+        except (OSError, socket.error, ValueError, UPnPService.SoapError) as ex:
+            logging.debug("upnp: Cached router %s is not valid: %s" % (dev, ex))
+            try:
+                os.remove(self.cache_path)
+            except OSError:
+                pass
+            return None
+        logging.debug(
+            "upnp: Using cached router %s, external address %s" % (dev, external_ip)
+        )
+        return dev
 
-    def discover_router(self):
-        router_l = []
+    def _save_cached_router(self):
+        if not self.cache_path or not self.router:
+            return
+        srv = self.router.forward_srv
+        cache = {
+            "ipaddr": self.router.ipaddr,
+            "xml_urls": sorted(self.router.xml_urls),
+            "service_type": srv.service_type,
+            "service_id": srv.service_id,
+            "control_url": srv.control_url,
+        }
         try:
-            devs = self._discover()
-            for dev in devs:
-                if dev.forward_srv:
-                    router_l.append(dev)
+            save_json(self.cache_path, cache)
         except (OSError, socket.error) as ex:
-            logging.error("upnp: failed to discover router: %s" % ex)
-        if not router_l:
-            self.router = None
-        elif len(router_l) > 1:
-            logging.warning("upnp: multiple routers found: %s" % (router_l,))
-            self.router = router_l[0]
-        else:
-            self.router = router_l[0]
-        return self.router
+            logging.warning("upnp: failed to save router cache: %s" % ex)
 
     def _discover(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -441,25 +1737,389 @@ class UPnPClient(object):
 
         return devs
 
+    def _discover_fast(self, deadline):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        socket_set_opt(sock, reuse=True)
+        executor = ThreadPoolExecutor(max_workers=self._fetch_workers)
+        finished = queue.Queue()
+        seen = set()
+        try:
+            for st in UPnPClient.IGD_SEARCH_TARGETS:
+                dat = (
+                    "M-SEARCH * HTTP/1.1\r\n"
+                    "ST: %s\r\n"
+                    "MX: 2\r\n"
+                    'MAN: "ssdp:discover"\r\n'
+                    "HOST: %s:%d\r\n"
+                    "\r\n" % ((st,) + self.ssdp_addr)
+                ).encode()
+                sock.sendto(dat, self.ssdp_addr)
+
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.debug("upnp: Discovery deadline reached")
+                    return None
+                readable, _, _ = select.select([sock], [], [], min(remaining, 0.05))
+                if readable:
+                    buff, addr = sock.recvfrom(4096)
+                    m = re.search(
+                        r"LOCATION: *(http://[^\[]\S+)\s+",
+                        buff.decode("utf-8", "ignore"),
+                        re.IGNORECASE,
+                    )
+                    if m and m.group(1) not in seen:
+                        location = m.group(1)
+                        seen.add(location)
+                        logging.debug("upnp: Got URL %s" % location)
+                        # description documents are fetched in parallel
+                        dev = UPnPDevice(addr[0], set([location]))
+                        fut = executor.submit(dev._load_services)
+                        fut.add_done_callback(lambda _, dev=dev: finished.put(dev))
+                while not finished.empty():
+                    dev = finished.get()
+                    if dev.forward_srv:
+                        return dev
+        finally:
+            executor.shutdown(wait=False)
+            sock.close()
+
+    def forward(self, host, port, dest_host, dest_port):
+        with trace_span("upnp.forward", port=port):
+            if not self.router:
+                raise RuntimeError("No router is available")
+            srv = self.router.forward_srv
+            try:
+                srv.add_port_mapping(host, port, dest_host, dest_port, self.lease)
+            except UPnPService.SoapError as ex:
+                # 725: OnlyPermanentLeasesSupported
+                if ex.errno != "725":
+                    raise ValueError("AddPortMapping failed: %s" % ex)
+                logging.debug("upnp: Router only supports permanent leases")
+                self.lease = 0
+                srv.add_port_mapping(host, port, dest_host, dest_port, 0)
+            self._fwd_host = host
+            self._fwd_port = port
+            self._fwd_dest_host = dest_host
+            self._fwd_dest_port = dest_port
+            self._fwd_started = True
+            self.verify()
+            if self.lease:
+                self._renew_stop.clear()
+                self._renew_thread = threading.Thread(
+                    target=self._renew, name="upnp-renew", daemon=True
+                )
+                self._renew_thread.start()
+
+    def verify(self):
+        try:
+            entry = self.router.forward_srv.get_port_mapping(
+                self._fwd_host, self._fwd_port
+            )
+        except UPnPService.SoapError as ex:
+            # 401: Invalid Action, 602: Optional Action Not Implemented
+            if ex.errno in ("401", "602"):
+                logging.debug("upnp: Router cannot verify port mappings: %s" % ex)
+                return
+            raise ValueError("Port mapping is not installed: %s" % ex)
+        if entry["NewInternalPort"] != str(self._fwd_dest_port) or entry[
+            "NewInternalClient"
+        ] not in (None, self._fwd_dest_host):
+            raise ValueError(
+                "Port mapping points to %s:%s"
+                % (entry["NewInternalClient"], entry["NewInternalPort"])
+            )
+        logging.debug(
+            "upnp: Port mapping %d => %s verified"
+            % (self._fwd_port, addr_to_str((self._fwd_dest_host, self._fwd_dest_port)))
+        )
+
+    def _renew(self):
+        interval = self.lease / 2
+        while not self._renew_stop.wait(interval):
+            try:
+                self.router.forward_srv.add_port_mapping(
+                    self._fwd_host,
+                    self._fwd_port,
+                    self._fwd_dest_host,
+                    self._fwd_dest_port,
+                    self.lease,
+                )
+                self.verify()
+                interval = self.lease / 2
+            except (OSError, socket.error, ValueError, UPnPService.SoapError) as ex:
+                logging.error("upnp: failed to renew port mapping: %s" % ex)
+                interval = self._retry_interval
+
+    def clear(self):
+        with trace_span("upnp.clear"):
+            if not self._fwd_started:
+                return
+            self._fwd_started = False
+            self._renew_stop.set()
+            srv = self.router.forward_srv
+            try:
+                srv.delete_port_mapping(self._fwd_host, self._fwd_port)
+            except UPnPService.SoapError as ex:
+                # 714: NoSuchEntryInArray, the mapping is gone already
+                if ex.errno != "714":
+                    logging.debug("upnp: DeletePortMapping failed: %s" % ex)
+                    # fall back to letting the mapping expire right away
+                    srv.forward_port(
+                        self._fwd_host,
+                        self._fwd_port,
+                        self._fwd_dest_host,
+                        self._fwd_dest_port,
+                        1,
+                    )
+            finally:
+                srv.close()
+
+
+class NatPmpClient(object):
+    # ref: https://www.rfc-editor.org/rfc/rfc6887 (PCP)
+    # ref: https://www.rfc-editor.org/rfc/rfc6886 (NAT-PMP)
+    PCP_VERSION = 2
+    NATPMP_VERSION = 0
+
+    class PortMismatch(ValueError):
+        pass
+
+    _unsupported = {}  # gateway => time until which it is not asked again
+    _unsupported_lock = threading.Lock()
+    UNSUPPORTED_TTL = 600
+
+    def __init__(self, gateway=None, lease=3600, port=5351):
+        self.gateway = gateway or get_default_gateway()
+        self.port = port
+        self.lease = lease
+        self.version = None
+        self.external_ip = None
+        self._timeout = 0.25
+        self._tries = 3
+        self._retry_interval = 30
+        self._nonce = os.urandom(12)
+        self._fwd_host = None
+        self._fwd_port = None
+        self._fwd_dest_host = None
+        self._fwd_dest_port = None
+        self._fwd_started = False
+        self._renew_stop = threading.Event()
+        self._renew_thread = None
+
+    @classmethod
+    def invalidate(cls):
+        # the gateway may have rebooted or the network changed
+        with cls._unsupported_lock:
+            cls._unsupported.clear()
+
+    @classmethod
+    def _is_unsupported(cls, gateway):
+        with cls._unsupported_lock:
+            until = cls._unsupported.get(gateway)
+            if until is not None and until <= time.monotonic():
+                del cls._unsupported[gateway]
+                until = None
+        return until is not None
+
+    def __repr__(self):
+        return "<NatPmpClient gateway=%s, version=%s>" % (
+            repr(self.gateway),
+            repr(self.version),
+        )
+
     def forward(self, host, port, dest_host, dest_port):
-        if not self.router:
-            raise RuntimeError("No router is available")
-        self.router.forward_srv.forward_port(host, port, dest_host, dest_port)
-        self._fwd_host = host
-        self._fwd_port = port
-        self._fwd_dest_host = dest_host
-        self._fwd_dest_port = dest_port
-        self._fwd_started = True
+        with trace_span("natpmp.forward", port=port):
+            if not self.gateway:
+                raise RuntimeError("No gateway is available")
+            if NatPmpClient._is_unsupported(self.gateway):
+                raise RuntimeError(
+                    "Gateway %s does not support PCP or NAT-PMP" % self.gateway
+                )
+            self._fwd_host = host
+            self._fwd_port = port
+            self._fwd_dest_host = dest_host
+            self._fwd_dest_port = dest_port
+            try:
+                self._map(self.lease)
+            except NatPmpClient.PortMismatch:
+                # the gateway has installed the mapping all the same
+                try:
+                    self._map(0)
+                except (OSError, socket.error, ValueError, RuntimeError) as ex:
+                    logging.debug("natpmp: failed to delete port mapping: %s" % ex)
+                raise
+            self._fwd_started = True
+            self._renew_stop.clear()
+            self._renew_thread = threading.Thread(
+                target=self._renew, name="natpmp-renew", daemon=True
+            )
+            self._renew_thread.start()
 
     def clear(self):
-        if self._fwd_started:
-            self.router.forward_srv.forward_port(
-                self._fwd_host,
-                self._fwd_port,
-                self._fwd_dest_host,
-                self._fwd_dest_port,
-                1,
+        with trace_span("natpmp.clear"):
+            if not self._fwd_started:
+                return
+            self._fwd_started = False
+            self._renew_stop.set()
+            try:
+                # a lifetime of zero deletes the mapping
+                self._map(0)
+            except (OSError, socket.error, ValueError, RuntimeError) as ex:
+                logging.debug("natpmp: failed to delete port mapping: %s" % ex)
+
+    def _renew(self):
+        interval = self.lease / 2
+        while not self._renew_stop.wait(interval):
+            try:
+                self._map(self.lease)
+                interval = self.lease / 2
+            except (OSError, socket.error, ValueError, RuntimeError) as ex:
+                logging.error("natpmp: failed to renew port mapping: %s" % ex)
+                interval = self._retry_interval
+
+    def _map(self, lifetime):
+        if self.version in (None, NatPmpClient.PCP_VERSION):
+            resp = self._request(self._pcp_map_request(lifetime))
+            if resp is None:
+                with NatPmpClient._unsupported_lock:
+                    NatPmpClient._unsupported[self.gateway] = (
+                        time.monotonic() + NatPmpClient.UNSUPPORTED_TTL
+                    )
+                raise RuntimeError("No response from gateway %s" % self.gateway)
+            if resp[0] == NatPmpClient.PCP_VERSION:
+                self.version = NatPmpClient.PCP_VERSION
+                return self._pcp_map_response(resp, lifetime)
+            # a NAT-PMP only gateway answers with UNSUPP_VERSION
+            self.version = NatPmpClient.NATPMP_VERSION
+        if self.external_ip is None:
+            resp = self._request(struct.pack("!BB", NatPmpClient.NATPMP_VERSION, 0))
+            if resp is None or len(resp) < 12:
+                raise RuntimeError("No response from gateway %s" % self.gateway)
+            _, _, result, _, ip = struct.unpack("!BBHLL", resp[:12])
+            if result == 0:
+                self.external_ip = socket.inet_ntoa(struct.pack("!L", ip))
+        req = struct.pack(
+            "!BBHHHL",
+            NatPmpClient.NATPMP_VERSION,
+            2,  # map TCP
+            0,
+            self._fwd_dest_port,
+            self._fwd_port if lifetime else 0,
+            lifetime,
+        )
+        resp = self._request(req)
+        if resp is None or len(resp) < 16:
+            raise RuntimeError("No response from gateway %s" % self.gateway)
+        _, opcode, result, _, _, ext_port, _ = struct.unpack("!BBHLHHL", resp[:16])
+        if opcode != 130 or result != 0:
+            raise ValueError("NAT-PMP mapping failed with result code %d" % result)
+        self._check_port(ext_port, lifetime)
+
+    def _pcp_map_request(self, lifetime):
+        client_ip = b"\0" * 10 + b"\xff\xff" + socket.inet_aton(self._fwd_dest_host)
+        header = struct.pack("!BBHL", NatPmpClient.PCP_VERSION, 1, 0, lifetime)
+        payload = (
+            self._nonce
+            + struct.pack("!B3xHH", 6, self._fwd_dest_port, self._fwd_port)
+            + b"\0" * 10
+            + b"\xff\xff"
+            + b"\0" * 4
+        )
+        return header + client_ip + payload
+
+    def _pcp_map_response(self, resp, lifetime):
+        if len(resp) < 60:
+            raise ValueError("Invalid PCP response")
+        _, opcode, result, _, _ = struct.unpack("!BBxBLL", resp[:12])
+        if opcode != 0x81 or result != 0:
+            raise ValueError("PCP mapping failed with result code %d" % result)
+        if resp[24:36] != self._nonce:
+            raise ValueError("PCP response nonce mismatch")
+        ext_port = struct.unpack("!H", resp[42:44])[0]
+        self.external_ip = socket.inet_ntoa(resp[56:60])
+        self._check_port(ext_port, lifetime)
+
+    def _check_port(self, ext_port, lifetime):
+        if not lifetime:
+            return
+        # the STUN mapping only holds if the gateway keeps the port number
+        if ext_port != self._fwd_port:
+            raise NatPmpClient.PortMismatch(
+                "Gateway assigned port %d instead of %d" % (ext_port, self._fwd_port)
             )
+        logging.debug(
+            "natpmp: Port %d mapped by %s, external address %s"
+            % (ext_port, self, self.external_ip)
+        )
+
+    def _request(self, data):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((self.gateway, self.port))
+            timeout = self._timeout
+            for _ in range(self._tries):
+                sock.send(data)
+                sock.settimeout(timeout)
+                try:
+                    return sock.recv(1100)
+                except socket.timeout:
+                    # RFC 6886 doubles the interval on every retry
+                    timeout *= 2
+                except ConnectionRefusedError:
+                    return None
+            return None
+        finally:
+            sock.close()
+
+
+def get_default_gateway():
+    # the first default route may be a point-to-point link without one
+    for _, gateway in _default_routes():
+        if gateway:
+            return gateway
+    return None
+
+
+def get_default_route():
+    # (interface, gateway) of the IPv4 default route; the gateway is None
+    # on point-to-point links such as PPPoE
+    for route in _default_routes():
+        return route
+    return None
+
+
+def _default_routes():
+    if not sys.platform.startswith("linux"):
+        return
+    if not os.path.isfile("/proc/net/route"):
+        return
+    fo = open("/proc/net/route", "r")
+    lines = fo.readlines()[1:]
+    fo.close()
+    for line in lines:
+        fields = line.split()
+        # destination and mask 0.0.0.0, the gateway is set with RTF_GATEWAY
+        if len(fields) > 7 and fields[1] == "00000000" and fields[7] == "00000000":
+            gateway = None
+            if int(fields[3], 16) & 2:
+                gateway = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+            yield fields[0], gateway
+
+
+def get_network_id():
+    # the default gateway and its MAC address, stable across outer IP changes
+    gateway = get_default_gateway()
+    if not gateway or not os.path.isfile("/proc/net/arp"):
+        return gateway
+    fo = open("/proc/net/arp", "r")
+    lines = fo.readlines()[1:]
+    fo.close()
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 3 and fields[0] == gateway:
+            return "%s/%s" % (gateway, fields[3])
+    return gateway
 
 
 def socket_set_opt(sock, reuse=False, bind_addr=None, timeout=-1):
@@ -475,6 +2135,20 @@ def socket_set_opt(sock, reuse=False, bind_addr=None, timeout=-1):
     return sock
 
 
+def socket_set_keepalive(sock, idle=15, interval=5, count=3):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle))
+    elif hasattr(socket, "TCP_KEEPALIVE"):
+        # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, int(idle))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(interval))
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, int(count))
+    return sock
+
+
 def check_docker_network():
     if not sys.platform.startswith("linux"):
         return
@@ -528,6 +2202,170 @@ def full_url(u, refurl):
     return "http://%s:%d" % (hostname, port) + u
 
 
+def http_read_response(sock, sink=None, limit=HTTP_MAX_BODY):
+    # Reads one HTTP/1.x response, framed by Content-Length, chunked encoding
+    # or connection close. The body is handed to `sink` piece by piece as
+    # memoryviews that are only valid during the call, or returned as bytes.
+    # Returns (status, headers, body, keep_alive).
+    buff = bytearray(HTTP_MAX_HEADER)
+    view = memoryview(buff)
+    n = 0
+    end = -1
+    while end < 0:
+        if n == len(buff):
+            raise ValueError("HTTP header too large")
+        r = sock.recv_into(view[n:])
+        if not r:
+            raise OSError("Connection closed by the server")
+        end = buff.find(b"\r\n\r\n", max(0, n - 3), n + r)
+        n += r
+    lines = bytes(view[:end]).decode("latin-1").split("\r\n")
+    m = re.match(r"^HTTP/1\.([01]) +(\d{3})", lines[0])
+    if not m:
+        raise ValueError("Invalid response from HTTP server")
+    status = int(m.group(2))
+    headers = {}
+    for line in lines[1:]:
+        k, sep, v = line.partition(":")
+        if sep:
+            headers[k.strip().lower()] = v.strip()
+    conn_hdr = headers.get("connection", "").lower()
+    keep = conn_hdr == "keep-alive" if m.group(1) == "0" else conn_hdr != "close"
+
+    length = None
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        chunks = _http_chunked_body(sock, view[end + 4 : n])
+    elif "content-length" in headers:
+        try:
+            length = int(headers["content-length"])
+        except ValueError:
+            raise ValueError("Invalid Content-Length from HTTP server")
+        if length > limit:
+            raise ValueError("HTTP body too large: %d bytes" % length)
+        chunks = _http_sized_body(sock, view[end + 4 : n], length)
+    elif status == 204 or status == 304 or status < 200:
+        length = 0
+        chunks = ()
+    else:
+        keep = False
+        chunks = _http_sized_body(sock, view[end + 4 : n], None)
+
+    if sink is not None:
+        size = 0
+        for data in chunks:
+            size += len(data)
+            if size > limit:
+                raise ValueError("HTTP body too large")
+            sink(data)
+        return status, headers, None, keep
+
+    if length is not None:
+        body = bytearray(length)
+        size = 0
+        for data in chunks:
+            body[size : size + len(data)] = data
+            size += len(data)
+        del body[size:]
+    else:
+        body = bytearray()
+        for data in chunks:
+            if len(body) + len(data) > limit:
+                raise ValueError("HTTP body too large")
+            body += data
+    return status, headers, bytes(body), keep
+
+
+def _http_sized_body(sock, pending, length):
+    # `length` of None reads until the server closes the connection
+    if length is not None:
+        pending = pending[:length]
+        left = length - len(pending)
+    if pending:
+        yield pending
+    buff = bytearray(65536)
+    view = memoryview(buff)
+    while length is None or left > 0:
+        r = sock.recv_into(view if length is None else view[: min(left, len(buff))])
+        if not r:
+            if length is None:
+                return
+            raise OSError("Connection closed by the server")
+        if length is not None:
+            left -= r
+        yield view[:r]
+
+
+def _http_chunked_body(sock, pending):
+    buff = bytearray(65536)
+    view = memoryview(buff)
+    pending = bytearray(pending)
+
+    def fill():
+        r = sock.recv_into(view)
+        if not r:
+            raise OSError("Connection closed by the server")
+        pending.extend(view[:r])
+
+    def read_line():
+        while True:
+            i = pending.find(b"\r\n")
+            if i >= 0:
+                line = bytes(pending[:i])
+                del pending[: i + 2]
+                return line
+            if len(pending) > 4096:
+                raise ValueError("Invalid chunked encoding from HTTP server")
+            fill()
+
+    while True:
+        try:
+            size = int(read_line().split(b";", 1)[0], 16)
+        except ValueError:
+            raise ValueError("Invalid chunked encoding from HTTP server")
+        if size == 0:
+            while read_line():
+                pass  # trailers
+            return
+        if pending:
+            data = bytes(pending[:size])
+            del pending[:size]
+            size -= len(data)
+            yield data
+        while size > 0:
+            r = sock.recv_into(view[: min(size, len(buff))])
+            if not r:
+                raise OSError("Connection closed by the server")
+            size -= r
+            yield view[:r]
+        if read_line():
+            raise ValueError("Invalid chunked encoding from HTTP server")
+
+
+def get_local_ip(remote_addr):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # no packet is sent, this only asks the kernel for a route
+        sock.connect(remote_addr)
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, "r", encoding="utf-8") as fo:
+            return json.load(fo)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w", encoding="utf-8") as fo:
+        json.dump(data, fo, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
 def addr_to_str(addr):
     return "%s:%d" % addr
 
@@ -536,30 +2374,68 @@ def addr_to_uri(addr):
     return "tcp://%s:%d" % addr
 
 
-def natter():
+STUN_SERVERS = [
+    "fwa.lifesizecloud.com",
+    "global.turn.twilio.com",
+    "turn.cloudflare.com",
+    "stun.isp.net.au",
+    "stun.nextcloud.com",
+    "stun.freeswitch.org",
+    "stun.voip.blackberry.com",
+    "stunserver.stunprotocol.org",
+    "stun.sipnet.com",
+    "stun.radiojar.com",
+    "stun.sonetel.com",
+    "stun.telnyx.com",
+]
+
+# servers known to answer CHANGE-REQUEST with OTHER-ADDRESS (RFC 5780)
+NAT_TEST_SERVERS = [
+    "stunserver.stunprotocol.org",
+    "stun.hot-chilli.net",
+]
+
+
+def parse_server_list(items, default_port):
+    srv_list = []
+    for item in items:
+        l = item.split(":", 2) + [str(default_port)]
+        srv_list.append((l[0], int(l[1])))
+    return srv_list
+
+
+def discover_upnp_router(upnp):
+    logging.info("Scanning UPnP Devices...")
+    start_time = time.monotonic()
+    result = "error"
+    router = None
+    try:
+        router = upnp.discover_router(fast=True)
+        result = "found" if router else "not_found"
+    except (OSError, socket.error, ValueError) as ex:
+        logging.error("upnp: failed to discover router: %s" % ex)
+    if metrics:
+        metrics.upnp_discovery.observe(time.monotonic() - start_time, result=result)
+    return router
+
+
+def natter(
+    scoreboard=None,
+    on_keepalive=None,
+    on_mapping_change=None,
+    upnp_cache_path=None,
+    stun_list=None,
+    nat_test_list=None,
+    keepalive_server=None,
+    ssdp_addr=None,
+    natpmp_gateway=None,
+    router=None,
+    keepalive_interval=15,
+):
     sys.tracebacklimit = 0
 
-    stun_list = [
-        "fwa.lifesizecloud.com",
-        "global.turn.twilio.com",
-        "turn.cloudflare.com",
-        "stun.isp.net.au",
-        "stun.nextcloud.com",
-        "stun.freeswitch.org",
-        "stun.voip.blackberry.com",
-        "stunserver.stunprotocol.org",
-        "stun.sipnet.com",
-        "stun.radiojar.com",
-        "stun.sonetel.com",
-        "stun.telnyx.com",
-    ]
-
-    stun_srv_list = []
-    for item in stun_list:
-        l = item.split(":", 2) + ["3478"]
-        stun_srv_list.append(
-            (l[0], int(l[1])),
-        )
+    stun_srv_list = parse_server_list(stun_list or STUN_SERVERS, 3478)
+    nat_test_srv_list = parse_server_list(nat_test_list or NAT_TEST_SERVERS, 3478)
 
     #
     #  Natter
@@ -568,31 +2444,94 @@ def natter():
 
     check_docker_network()
 
-    stun = StunClient(stun_srv_list)
+    stun = StunClient(stun_srv_list, concurrency=4, scoreboard=scoreboard)
 
-    natter_addr, outer_addr = stun.get_mapping()
-    inner_ip, inner_port = natter_addr
-    outer_ip, outer_port = outer_addr
+    # Stages only wait for the data they need: router discovery runs
+    # alongside STUN, the NAT behavior test alongside port forwarding.
+    timer = StageTimer()
+    pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        upnp_client = UPnPClient(upnp_cache_path)
+        if ssdp_addr:
+            l = ssdp_addr.split(":", 2) + ["1900"]
+            upnp_client.ssdp_addr = (l[0], int(l[1]))
+        if router:
+            # reuse a router found by an earlier call, skipping discovery
+            upnp_client.router = router
+            discovery = None
+        else:
+            discovery = pool.submit(
+                timer.run, "upnp.discover", discover_upnp_router, upnp_client
+            )
 
-    keepalive_srv = "www.baidu.com"
-    keepalive_port = 80
-    keep_alive(keepalive_srv, keepalive_port, inner_ip, inner_port)
+        natter_addr, outer_addr = timer.run("stun", stun.get_mapping)
+        inner_ip, inner_port = natter_addr
+        outer_ip, outer_port = outer_addr
 
-    # UPnP
-    upnp_router = None
+        nat_test = NatBehaviorTest(nat_test_srv_list)
+        behavior_test = pool.submit(
+            timer.run, "nat_test", nat_test.get_behavior, inner_ip, outer_ip
+        )
 
-    upnp = UPnPClient()
-    logging.info("Scanning UPnP Devices...")
-    try:
-        upnp_router = upnp.discover_router()
-    except (OSError, socket.error, ValueError) as ex:
-        logging.error("upnp: failed to discover router: %s" % ex)
+        l = (keepalive_server or "www.baidu.com").split(":", 2) + ["80"]
+        keepalive_srv, keepalive_port = l[0], int(l[1])
+        keepalive = KeepAliveSession(
+            keepalive_srv,
+            keepalive_port,
+            inner_ip,
+            inner_port,
+            interval=keepalive_interval,
+            on_status=on_keepalive,
+        )
+        keepalive.start()
 
-    if upnp_router:
-        logging.info("[UPnP] Found router %s" % upnp_router.ipaddr)
+        # PCP / NAT-PMP, one UDP packet to the gateway
+        if natpmp_gateway:
+            l = natpmp_gateway.split(":", 2) + ["5351"]
+            upnp = NatPmpClient(l[0], port=int(l[1]))
+        else:
+            upnp = NatPmpClient()
         try:
-            upnp.forward("", inner_port, inner_ip, inner_port)
-        except (OSError, socket.error, ValueError) as ex:
-            logging.error("upnp: failed to forward port: %s" % ex)
+            timer.run("natpmp", upnp.forward, "", inner_port, inner_ip, inner_port)
+            logging.info("[NAT-PMP] Port forwarded by gateway %s" % upnp.gateway)
+        except (OSError, socket.error, ValueError, RuntimeError) as ex:
+            logging.debug("natpmp: failed to forward port: %s" % ex)
+            upnp = None
+
+        # UPnP
+        if upnp is None:
+            upnp = upnp_client
+            upnp_router = discovery.result() if discovery else router
+            if upnp_router:
+                logging.info("[UPnP] Found router %s" % upnp_router.ipaddr)
+                try:
+                    timer.run(
+                        "upnp.forward",
+                        upnp.forward,
+                        "",
+                        inner_port,
+                        inner_ip,
+                        inner_port,
+                    )
+                except (OSError, socket.error, ValueError, UPnPService.SoapError) as ex:
+                    logging.error("upnp: failed to forward port: %s" % ex)
+
+        nat_behavior = behavior_test.result()
+        logging.info(
+            "NAT mapping: %s, filtering: %s"
+            % (nat_behavior.mapping, nat_behavior.filtering)
+        )
+    finally:
+        # a discovery made unnecessary by NAT-PMP finishes on its own
+        pool.shutdown(wait=False)
+
+    monitor = MappingMonitor(stun, outer_addr, on_change=on_mapping_change)
+    monitor.start()
 
-    return inner_port, outer_ip, outer_port, upnp
+    logging.debug(
+        "Startup took %.2fs, %.2fs if run sequentially"
+        % (timer.elapsed(), timer.serial())
+    )
+    return NatterMapping(
+        natter_addr, outer_addr, upnp, nat_behavior, keepalive, monitor, timer
+    )
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+import threading
+
+# 未启用时span()返回同一个空对象，开销仅为一次判断
+_file = None
+_lock = threading.Lock()
+_base = time.perf_counter()
+_pid = os.getpid()
+_tracks = {}  # 轨道名或线程ID => tid
+_track_lock = threading.Lock()
+
+
+def enable(path):
+    # 逐条追加事件，进程意外退出时文件仍可打开（Chrome允许省略结尾的"]"）
+    global _file
+    try:
+        fo = open(path, "wb")
+    except OSError as e:
+        logging.error(f"无法写入追踪文件{path}：{e}")
+        return False
+    fo.write(b"[\n")
+    fo.flush()
+    _file = fo
+    logging.info(f"追踪已启用，输出至{path}")
+    return True
+
+
+def enabled():
+    return _file is not None
+
+
+def close():
+    global _file
+    with _lock:
+        if _file is None:
+            return
+        fo, _file = _file, None
+        # 去掉最后一个事件后的逗号
+        if fo.tell() > 2:
+            fo.seek(-2, os.SEEK_END)
+            fo.truncate()
+        fo.write(b"\n]\n")
+        fo.close()
+
+
+def _tid(track):
+    # 无track时按线程区分；指定track时归入同名的虚拟轨道，用于交错执行的异步任务
+    key = track if track is not None else threading.get_ident()
+    tid = _tracks.get(key)
+    if tid is not None:
+        return tid
+    with _track_lock:
+        tid = _tracks.get(key)
+        if tid is not None:
+            return tid
+        tid = _tracks[key] = len(_tracks) + 1
+    name = track if track is not None else threading.current_thread().name
+    _write(
+        {
+            "ph": "M",
+            "name": "thread_name",
+            "pid": _pid,
+            "tid": tid,
+            "args": {"name": name},
+        }
+    )
+    return tid
+
+
+def _write(event):
+    line = (json.dumps(event, ensure_ascii=False, default=str) + ",\n").encode()
+    with _lock:
+        if _file is None:
+            return
+        _file.write(line)
+        _file.flush()
+
+
+class _Span:
+    __slots__ = ("name", "args", "track", "start")
+
+    def __init__(self, name, track, args):
+        self.name = name
+        self.track = track
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _write(
+            {
+                "ph": "X",
+                "name": self.name,
+                "pid": _pid,
+                "tid": _tid(self.track),
+                "ts": round((self.start - _base) * 1e6, 1),
+                "dur": round((end - self.start) * 1e6, 1),
+                "args": self.args,
+            }
+        )
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_null = _NullSpan()
+
+
+def span(name, track=None, **args):
+    if _file is None:
+        return _null
+    return _Span(name, track, args)
+
+
+def instant(name, track=None, **args):
+    if _file is None:
+        return
+    _write(
+        {
+            "ph": "i",
+            "s": "t",
+            "name": name,
+            "pid": _pid,
+            "tid": _tid(track),
+            "ts": round((time.perf_counter() - _base) * 1e6, 1),
+            "args": args,
+        }
+    )